@@ -1,5 +1,7 @@
+from . import delivery_carrier
 from . import delivery_carrier_preference
 from . import procurement_group
 from . import stock_move
 from . import stock_picking
 from . import stock_location_route
+from . import stock_quant
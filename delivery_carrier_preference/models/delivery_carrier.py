@@ -0,0 +1,14 @@
+# Copyright 2020 Camptocamp SA
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl)
+from odoo import models
+
+
+class DeliveryCarrier(models.Model):
+    _inherit = "delivery.carrier"
+
+    def unlink(self):
+        res = super().unlink()
+        # the preferences of the carriers are deleted in cascade by the
+        # database, which bypasses the refresh of their index
+        self.env["delivery.carrier.preference"].clear_caches()
+        return res
@@ -1,8 +1,30 @@
 # Copyright 2020 Camptocamp SA
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl)
-from odoo import _, api, fields, models
+import operator
+from bisect import bisect_left
+
+from odoo import _, api, fields, models, tools
 from odoo.exceptions import ValidationError
+from odoo.osv.expression import FALSE_LEAF, TRUE_LEAF, normalize_domain
 from odoo.tools import float_compare
+from odoo.tools.safe_eval import const_eval
+
+# operators of the picking domains which can be evaluated in memory
+PREDICATE_OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "in": lambda value, values: value in values,
+    "not in": lambda value, values: value not in values,
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+}
+PREDICATE_EQUALITY_OPERATORS = ("=", "!=", "in", "not in")
+# types of the picking fields which can be evaluated in memory, the numeric
+# fields must be required as their null value is read as 0 by the ORM
+PREDICATE_FIELD_TYPES = ("char", "selection", "boolean", "many2one")
+PREDICATE_NUMERIC_FIELD_TYPES = ("integer", "float", "monetary")
 
 
 class DeliveryCarrierPreference(models.Model):
@@ -40,6 +62,138 @@ class DeliveryCarrierPreference(models.Model):
         "for carrier selection on pickings",
     )
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.clear_caches()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
+
+    @api.model
+    @tools.ormcache("company_id")
+    def _get_weight_band_index(self, company_id):
+        """Index the preferences of a company by weight band
+
+        Return a tuple ``(max_weights, bands)``. ``max_weights`` are the
+        sorted distinct max weights of the preferences with a limit.
+        ``bands[i]`` are the ids of the preferences applicable up to
+        ``max_weights[i]``, in their order; the last band holds the
+        preferences without limit.
+        """
+        preferences = self.sudo().search([("company_id", "=", company_id)])
+        max_weights = tuple(
+            sorted(set(preferences.filtered("max_weight").mapped("max_weight")))
+        )
+        bands = tuple(
+            tuple(
+                pref.id
+                for pref in preferences
+                if not pref.max_weight or pref.max_weight >= max_weight
+            )
+            for max_weight in max_weights
+        )
+        bands += (tuple(pref.id for pref in preferences if not pref.max_weight),)
+        return max_weights, bands
+
+    @api.model
+    def _get_preferences_for_weight(self, company, weight):
+        """Return the preferences of the company applicable to the weight"""
+        max_weights, bands = self._get_weight_band_index(company.id)
+        return self.browse(bands[bisect_left(max_weights, weight)])
+
+    @api.model
+    @tools.ormcache("picking_domain")
+    def _get_picking_domain_predicate(self, picking_domain):
+        """Compile a picking domain into a predicate on pickings
+
+        The predicate evaluates the domain on the pickings in memory. Return
+        None when the domain uses paths, fields or operators which can only
+        be evaluated by a search.
+        """
+        domain = normalize_domain(const_eval(picking_domain or "[]"))
+        picking_model = self.env["stock.picking"]
+        stack = []
+        for token in reversed(domain):
+            if token == "!":
+                predicate = stack.pop()
+                stack.append(lambda picking, pred=predicate: not pred(picking))
+            elif token in ("&", "|"):
+                left, right = stack.pop(), stack.pop()
+                if token == "&":
+                    stack.append(
+                        lambda picking, a=left, b=right: a(picking) and b(picking)
+                    )
+                else:
+                    stack.append(
+                        lambda picking, a=left, b=right: a(picking) or b(picking)
+                    )
+            else:
+                predicate = self._get_picking_domain_leaf_predicate(
+                    picking_model, token
+                )
+                if predicate is None:
+                    return None
+                stack.append(predicate)
+        if not stack:
+            return lambda picking: True
+        return stack[0]
+
+    @api.model
+    def _get_picking_domain_leaf_predicate(self, picking_model, leaf):
+        if tuple(leaf) in (TRUE_LEAF, FALSE_LEAF):
+            return None
+        fname, op, value = leaf
+        field = picking_model._fields.get(fname)
+        if not field or not field.store or op not in PREDICATE_OPERATORS:
+            return None
+        if field.type in PREDICATE_NUMERIC_FIELD_TYPES:
+            if not field.required:
+                return None
+        elif (
+            field.type not in PREDICATE_FIELD_TYPES
+            or op not in PREDICATE_EQUALITY_OPERATORS
+        ):
+            return None
+        if op in ("in", "not in"):
+            if not isinstance(value, (list, tuple)):
+                return None
+            values = tuple(value)
+        else:
+            values = (value,)
+        if field.type == "many2one":
+            if not all(val is False or isinstance(val, int) for val in values):
+                return None
+
+            def get_value(picking):
+                return picking[fname].id
+
+        elif field.type == "boolean":
+            value = (
+                tuple(bool(val) for val in values)
+                if op in ("in", "not in")
+                else bool(value)
+            )
+
+            def get_value(picking):
+                return bool(picking[fname])
+
+        else:
+
+            def get_value(picking):
+                return picking[fname]
+
+        compare = PREDICATE_OPERATORS[op]
+        return lambda picking: compare(get_value(picking), value)
+
     @api.constrains("preference", "carrier_id")
     def _check_preference_carrier_id(self):
         for pref in self:
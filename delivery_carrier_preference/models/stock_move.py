@@ -1,8 +1,14 @@
 # Copyright 2020 Camptocamp SA
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl)
+from collections import defaultdict
 from itertools import groupby
 
 from odoo import api, fields, models, tools
+from odoo.tools.sql import column_exists, create_column
+
+from odoo.addons.stock_available_to_promise_release.models.stock_move import (
+    ORDERED_AVAILABLE_TO_PROMISE_FIELDS,
+)
 
 
 class StockMove(models.Model):
@@ -12,17 +18,51 @@ class StockMove(models.Model):
     estimated_shipping_weight = fields.Float(
         string="Estimated shipping weight",
         compute="_compute_estimated_shipping_weight",
+        store=True,
         help="Total weight available to promise calculated according to the"
         " quantity available to promise and weight defined on packagings "
         "for this product.",
     )
 
+    def _auto_init(self):
+        # Create the column beforehand so the ORM does not compute the
+        # weight of every move ever done when the module is installed or
+        # upgraded, only the moves to release are computed, once all the
+        # models have been initialized.
+        new_column = not column_exists(
+            self.env.cr, "stock_move", "estimated_shipping_weight"
+        )
+        if new_column:
+            create_column(
+                self.env.cr, "stock_move", "estimated_shipping_weight", "numeric"
+            )
+        res = super()._auto_init()
+        if new_column:
+            self.pool.post_init(self._init_estimated_shipping_weight)
+        return res
+
+    def _init_estimated_shipping_weight(self):
+        """Compute the estimated shipping weight of the moves to release"""
+        moves = self.search(
+            [("need_release", "=", True), ("state", "in", ("confirmed", "waiting"))]
+        )
+        moves._recompute_estimated_shipping_weight()
+        self.env["base"].flush()
+
+    # The available to promise also depends on the stock and on the other
+    # moves, which are not dependencies: the weights of the moves to release
+    # are refreshed for their products by ``_refresh_estimated_shipping_weight``
+    # when moves are created, when the fields changing the available to
+    # promise of the other moves are written and when quants change, once at
+    # the end of the reservations, releases, cancellations and validations.
     @api.depends(
         "product_id",
         "product_id.packaging_ids",
         "product_id.packaging_ids.max_weight",
         "product_id.weight",
-        "ordered_available_to_promise",
+        "product_qty",
+        "need_release",
+        "state",
     )
     def _compute_estimated_shipping_weight(self):
         for move in self:
@@ -31,6 +71,81 @@ class StockMove(models.Model):
                 move.ordered_available_to_promise
             )
 
+    @api.model
+    def _refresh_estimated_shipping_weight(self, products):
+        """Recompute the estimated shipping weight of the moves to release
+
+        Only the moves of ``products`` and their pickings are recomputed.
+        Nothing is done in the operations which change many moves or quants
+        (context key ``defer_estimated_shipping_weight``), they refresh the
+        weights once at their end.
+        """
+        if not products or self.env.context.get("defer_estimated_shipping_weight"):
+            return
+        moves = self.search(
+            [
+                ("product_id", "in", products.ids),
+                ("need_release", "=", True),
+                ("state", "in", ("confirmed", "waiting")),
+            ]
+        )
+        moves._recompute_estimated_shipping_weight()
+
+    def _recompute_estimated_shipping_weight(self):
+        """Mark the estimated shipping weight of the moves to recompute
+
+        The weights of the moves and of their pickings are recomputed
+        together at the next flush or read.
+        """
+        self.env.add_to_compute(self._fields["estimated_shipping_weight"], self)
+        pickings = self.picking_id
+        self.env.add_to_compute(pickings._fields["estimated_shipping_weight"], pickings)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        moves = super().create(vals_list)
+        self._refresh_estimated_shipping_weight(moves.product_id)
+        return moves
+
+    def write(self, vals):
+        refresh = ORDERED_AVAILABLE_TO_PROMISE_FIELDS.intersection(vals)
+        products = self.product_id
+        res = super().write(vals)
+        if refresh:
+            self._refresh_estimated_shipping_weight(products | self.product_id)
+        return res
+
+    def _with_deferred_estimated_shipping_weight(self):
+        return self.with_context(defer_estimated_shipping_weight=True)
+
+    def _action_assign(self):
+        res = super(
+            StockMove, self._with_deferred_estimated_shipping_weight()
+        )._action_assign()
+        self._refresh_estimated_shipping_weight(self.product_id)
+        return res
+
+    def _do_unreserve(self):
+        res = super(
+            StockMove, self._with_deferred_estimated_shipping_weight()
+        )._do_unreserve()
+        self._refresh_estimated_shipping_weight(self.product_id)
+        return res
+
+    def _action_cancel(self):
+        res = super(
+            StockMove, self._with_deferred_estimated_shipping_weight()
+        )._action_cancel()
+        self._refresh_estimated_shipping_weight(self.product_id)
+        return res
+
+    def _action_done(self, cancel_backorder=False):
+        done_moves = super(
+            StockMove, self._with_deferred_estimated_shipping_weight()
+        )._action_done(cancel_backorder=cancel_backorder)
+        self._refresh_estimated_shipping_weight(self.product_id)
+        return done_moves.with_env(self.env)
+
     def _get_new_picking_values(self):
         vals = super()._get_new_picking_values()
         # Take the carrier_id from the group only when we have a related line
@@ -51,50 +166,93 @@ class StockMove(models.Model):
             move.need_release
             # do not change the carrier is nothing can be released on the stock move
             and not tools.float_is_zero(
-                move._ordered_available_to_promise(), precision_digits=precision
+                move.ordered_available_to_promise, precision_digits=precision
             )
             and move.rule_id.route_id.force_recompute_preferred_carrier_on_release
         )
 
-    def release_available_to_promise(self):
-        modified_groups = {}
-        for picking in self.filtered(self._filter_recompute_preferred_carrier).mapped(
-            "picking_id"
-        ):
-            if picking.picking_type_code != "outgoing":
-                continue
-            picking.add_preferred_carrier()
+    @api.model
+    def _release_split_groups_by_carrier(self, pickings):
+        """Move the pickings to a new group when their carrier changed
 
-        # if we have other pickings in the same group and now they have different
-        # carriers, split them in 2 groups and sync the carrier on their group
-        sorted_pickings = self.mapped("picking_id").sorted(
-            lambda pick: (pick.group_id, pick.carrier_id)
-        )
+        The groups are created at once and the moves are written once per
+        new group. Return a dict ``{new group: original group}``.
+        """
+        sorted_pickings = pickings.sorted(lambda pick: (pick.group_id, pick.carrier_id))
+        regroups = []
         for (group, new_carrier), iter_pickings in groupby(
             sorted_pickings, lambda pick: (pick.group_id, pick.carrier_id)
         ):
-            pickings = self.env["stock.picking"].union(*iter_pickings)
             if group.carrier_id != new_carrier:
-                # always create a new procurement group when we change carrier,
-                # the old group will be reassigned to the backorders if any,
-                # otherwise it will stay empty in the depths of nothingness
-                new_group = group.copy(
-                    default={"name": "{} ({})".format(group.name, new_carrier.name)}
+                regroups.append(
+                    (
+                        group,
+                        new_carrier,
+                        self.env["stock.picking"].union(*iter_pickings),
+                    )
                 )
-                pickings.move_lines.group_id = new_group
+        if not regroups:
+            return {}
+        # always create a new procurement group when we change carrier,
+        # the old group will be reassigned to the backorders if any,
+        # otherwise it will stay empty in the depths of nothingness
+        vals_list = []
+        for group, new_carrier, __ in regroups:
+            vals_list += group.copy_data(
+                default={
+                    "name": "{} ({})".format(group.name, new_carrier.name),
+                    "carrier_id": new_carrier.id,
+                }
+            )
+        new_groups = self.env["procurement.group"].create(vals_list)
+        modified_groups = {}
+        for new_group, (group, __, group_pickings) in zip(new_groups, regroups):
+            group_pickings.move_lines.group_id = new_group
+            modified_groups[new_group] = group
+        return modified_groups
+
+    @api.model
+    def _release_restore_backorder_groups(self, modified_groups):
+        """Give back their original group and carrier to the backorders
+
+        ``modified_groups`` is the result of
+        ``_release_split_groups_by_carrier``. The moves are written once per
+        original group and the pickings once per carrier.
+        """
+        if not modified_groups:
+            return
+        new_groups = self.env["procurement.group"].union(*modified_groups)
+        need_release_pickings = new_groups.picking_ids.filtered("need_release")
+        pickings_by_group = defaultdict(lambda: self.env["stock.picking"].browse())
+        for picking in need_release_pickings:
+            pickings_by_group[modified_groups[picking.group_id]] |= picking
+        pickings_by_carrier = defaultdict(lambda: self.env["stock.picking"].browse())
+        for original_group, pickings in pickings_by_group.items():
+            pickings.move_lines.group_id = original_group
+            pickings_by_carrier[original_group.carrier_id] |= pickings
+        for carrier, pickings in pickings_by_carrier.items():
+            pickings.carrier_id = carrier
 
-                # sync carrier
-                new_group.carrier_id = new_carrier
-                modified_groups[new_group] = group
+    def release_available_to_promise(self):
+        # the preferred carriers depend on an up-to-date weight
+        self.filtered("need_release")._recompute_estimated_shipping_weight()
+        self.filtered(self._filter_recompute_preferred_carrier).picking_id.filtered(
+            lambda picking: picking.picking_type_code == "outgoing"
+        )._add_preferred_carriers()
+
+        # if we have other pickings in the same group and now they have different
+        # carriers, split them in 2 groups and sync the carrier on their group
+        modified_groups = self._release_split_groups_by_carrier(self.picking_id)
 
-        res = super().release_available_to_promise()
+        res = super(
+            StockMove, self._with_deferred_estimated_shipping_weight()
+        ).release_available_to_promise()
+        # the quantities available to promise of the moves not released, of
+        # the same products, have changed
+        self._refresh_estimated_shipping_weight(self.product_id)
 
-        for new_group, original_group in modified_groups.items():
-            # these are backorders created for unavailable qties,
-            # reassign them the original group and carrier
-            need_release_pickings = new_group.picking_ids.filtered("need_release")
-            # reassign the original group and carriers on the backorders
-            need_release_pickings.move_lines.group_id = original_group
-            need_release_pickings.carrier_id = original_group.carrier_id
+        # these are backorders created for unavailable qties,
+        # reassign them the original group and carrier
+        self._release_restore_backorder_groups(modified_groups)
 
         return res
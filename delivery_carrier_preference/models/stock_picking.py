@@ -1,8 +1,11 @@
 # Copyright 2020 Camptocamp SA
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl)
+from collections import defaultdict
+
 from odoo import _, api, fields, models
 from odoo.osv.expression import AND
 from odoo.tools.safe_eval import const_eval
+from odoo.tools.sql import column_exists, create_column
 
 
 class StockPicking(models.Model):
@@ -12,11 +15,23 @@ class StockPicking(models.Model):
     estimated_shipping_weight = fields.Float(
         string="Estimated shipping weight",
         compute="_compute_estimated_shipping_weight",
+        store=True,
         help="This weight is calculated according to the move quantity "
         "available to promise and existing product packagings weight for each "
         "product on the moves.",
     )
 
+    def _auto_init(self):
+        # Create the column beforehand so the ORM does not compute the
+        # weight of every picking when the module is installed, the pickings
+        # to release are computed with their moves (see
+        # ``stock.move._init_estimated_shipping_weight``).
+        if not column_exists(self.env.cr, "stock_picking", "estimated_shipping_weight"):
+            create_column(
+                self.env.cr, "stock_picking", "estimated_shipping_weight", "numeric"
+            )
+        return super()._auto_init()
+
     @api.depends("move_lines", "move_lines.estimated_shipping_weight")
     def _compute_estimated_shipping_weight(self):
         for pick in self:
@@ -41,53 +56,102 @@ class StockPicking(models.Model):
         else:
             self.carrier_id = carrier
 
+    def _add_preferred_carriers(self):
+        """Set the preferred carrier of many pickings at once
+
+        The pickings without preferred carrier keep their carrier.
+        """
+        pickings_by_carrier = defaultdict(lambda: self.browse())
+        for picking, carriers in self._get_preferred_carriers_by_picking().items():
+            carrier = fields.first(carriers)
+            if carrier and carrier != picking.carrier_id:
+                pickings_by_carrier[carrier] |= picking
+        for carrier, pickings in pickings_by_carrier.items():
+            pickings.carrier_id = carrier
+
     def get_preferred_carriers(self):
         # TODO Check possible conflicting settings between doc company and
         #  user preference defined on another company?
         self.ensure_one()
-        company_carriers = self.env["delivery.carrier"].search(
-            ["|", ("company_id", "=", False), ("company_id", "=", self.company_id.id)]
-        )
-        carrier_preferences = self.env["delivery.carrier.preference"].search(
-            [
-                "&",
-                "|",
-                ("max_weight", ">=", self.estimated_shipping_weight),
-                ("max_weight", "=", 0.0),
-                "|",
-                ("carrier_id", "in", company_carriers.ids),
-                ("carrier_id", "=", False),
-            ]
-        )
-        carriers_ids = list()
-        for cp in carrier_preferences:
-            if cp.picking_domain and not self._picking_domain_valid(cp):
-                continue
-
-            if cp.preference == "carrier":
-                carrier = cp.carrier_id
-                # carriers_ids.append(cp.carrier_id.id)
-            else:
-                # partner_carrier = self.partner_id.property_delivery_carrier_id
-                # if partner_carrier:
-                #     carriers_ids.append(partner_carrier.id)
-                carrier = self.partner_id.property_delivery_carrier_id
-            if not carrier or not self._carrier_valid(carrier):
-                continue
-            carriers_ids.append(carrier.id)
-        return (
-            self.env["delivery.carrier"]
-            .browse(carriers_ids)
-            .available_carriers(self.partner_id)
+        return self._get_preferred_carriers_by_picking()[self]
+
+    def _get_preferred_carriers_by_picking(self):
+        """Resolve the preferred carriers of many pickings at once
+
+        Return a dict ``{picking: carriers}`` with the same carriers as
+        ``get_preferred_carriers`` called on each picking. The carriers are
+        read once, the preferences of each picking are looked up by weight in
+        the index of its company and the domain of each preference is
+        evaluated once for all its pickings.
+        """
+        preference_model = self.env["delivery.carrier.preference"]
+        carriers = self.env["delivery.carrier"].search(
+            ["|", ("company_id", "=", False), ("company_id", "in", self.company_id.ids)]
         )
+        candidates = {}
+        pickings_by_preference = defaultdict(lambda: self.browse())
+        for picking in self:
+            candidates[picking] = preference_model._get_preferences_for_weight(
+                picking.company_id, picking.estimated_shipping_weight
+            )
+        # the index may hold preferences deleted in SQL, checked at once
+        existing = preference_model.union(*candidates.values()).exists()
+        for picking in self:
+            candidates[picking] = candidates[picking].filtered(
+                lambda cp: cp in existing
+            )
+            for cp in candidates[picking]:
+                if cp.picking_domain:
+                    pickings_by_preference[cp] |= picking
+        valid_pickings = {
+            cp: pickings._filter_picking_domain_valid(cp)
+            for cp, pickings in pickings_by_preference.items()
+        }
+        result = {}
+        for picking in self:
+            company_carriers = carriers.filtered(
+                lambda carrier: not carrier.company_id
+                or carrier.company_id == picking.company_id
+            )
+            carriers_ids = list()
+            for cp in candidates[picking]:
+                if cp.carrier_id and cp.carrier_id not in company_carriers:
+                    continue
+                if cp in valid_pickings and picking not in valid_pickings[cp]:
+                    continue
+                if cp.preference == "carrier":
+                    carrier = cp.carrier_id
+                else:
+                    carrier = picking.partner_id.property_delivery_carrier_id
+                if not carrier or not picking._carrier_valid(carrier):
+                    continue
+                carriers_ids.append(carrier.id)
+            result[picking] = (
+                self.env["delivery.carrier"]
+                .browse(carriers_ids)
+                .available_carriers(picking.partner_id)
+            )
+        return result
 
-    def _picking_domain_valid(self, carrier_preference):
-        self.ensure_one()
+    def _filter_picking_domain_valid(self, carrier_preference):
+        """Return the pickings matching the domain of the preference
+
+        The domain is evaluated in memory when it can be compiled, otherwise
+        with a search.
+        """
+        predicate = self.env[
+            "delivery.carrier.preference"
+        ]._get_picking_domain_predicate(carrier_preference.picking_domain)
+        if predicate is not None:
+            return self.filtered(predicate)
         domain = const_eval(carrier_preference.picking_domain)
         if not domain:
-            return True
-        else:
-            return self.search_count(AND([domain, [("id", "=", self.id)]]))
+            return self
+        return self.search(AND([domain, [("id", "in", self.ids)]]))
+
+    def _picking_domain_valid(self, carrier_preference):
+        self.ensure_one()
+        return bool(self._filter_picking_domain_valid(carrier_preference))
 
     def _carrier_valid(self, carrier):
         """Hook to add extra validation between carrier and picking"""
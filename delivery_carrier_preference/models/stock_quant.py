@@ -0,0 +1,26 @@
+# Copyright 2020 Camptocamp SA
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl)
+from odoo import api, models
+
+
+class StockQuant(models.Model):
+    _inherit = "stock.quant"
+
+    # the stock changes the estimated shipping weight of the moves to release
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        quants = super().create(vals_list)
+        self.env["stock.move"]._refresh_estimated_shipping_weight(quants.product_id)
+        return quants
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.env["stock.move"]._refresh_estimated_shipping_weight(self.product_id)
+        return res
+
+    def unlink(self):
+        products = self.product_id
+        res = super().unlink()
+        self.env["stock.move"]._refresh_estimated_shipping_weight(products)
+        return res
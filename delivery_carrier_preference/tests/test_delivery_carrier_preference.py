@@ -1,6 +1,9 @@
 # Copyright 2020 Camptocamp SA
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl)
+from unittest import mock
+
 from odoo.tests.common import Form
+from odoo.tools.safe_eval import safe_eval
 
 from odoo.addons.stock_available_to_promise_release.tests.common import (
     PromiseReleaseCommonCase,
@@ -155,3 +158,251 @@ class TestSaleDeliveryCarrierPreference(PromiseReleaseCommonCase):
         self.assertAlmostEqual(delivery_pick.estimated_shipping_weight, 50.0)
         delivery_pick.add_preferred_carrier()
         self.assertEqual(delivery_pick.carrier_id, self.free_delivery_carrier)
+
+    def test_estimated_shipping_weight_refresh(self):
+        """
+        With 4 available to promise and 2 orders of 3, the second delivery
+        weighs 10.0, once the first order is canceled the second delivery
+        weighs 30.0 and can be searched on its stored weight
+        """
+        self.env["stock.quant"]._update_available_quantity(
+            self.product, self.loc_stock, 4
+        )
+        order1 = self._create_sale_order()
+        self._update_order_line_qty(order1, 3)
+        order1.action_confirm()
+        order2 = self._create_sale_order()
+        self._update_order_line_qty(order2, 3)
+        order2.action_confirm()
+        delivery_pick = order2.picking_ids
+        self.assertAlmostEqual(delivery_pick.estimated_shipping_weight, 10.0)
+        move_class = type(self.env["stock.move"])
+        with mock.patch.object(
+            move_class,
+            "_recompute_estimated_shipping_weight",
+            autospec=True,
+            side_effect=move_class._recompute_estimated_shipping_weight,
+        ) as recompute:
+            order1.action_cancel()
+        # the weights are refreshed once for the whole cancellation
+        self.assertEqual(recompute.call_count, 1)
+        self.assertAlmostEqual(delivery_pick.estimated_shipping_weight, 30.0)
+        self.assertIn(
+            delivery_pick,
+            self.env["stock.picking"].search(
+                [("estimated_shipping_weight", ">", 20.0)]
+            ),
+        )
+
+    def test_init_estimated_shipping_weight(self):
+        """
+        The weights of the moves to release are computed when the columns
+        are created on the install or upgrade of the module
+        """
+        self.env["stock.quant"]._update_available_quantity(
+            self.product, self.loc_stock, 4
+        )
+        order = self._create_sale_order()
+        self._update_order_line_qty(order, 3)
+        order.action_confirm()
+        delivery_pick = order.picking_ids
+        self.env["base"].flush()
+        self.env.cr.execute(
+            "UPDATE stock_move SET estimated_shipping_weight = NULL WHERE id IN %s",
+            (tuple(delivery_pick.move_lines.ids),),
+        )
+        self.env.cr.execute(
+            "UPDATE stock_picking SET estimated_shipping_weight = NULL WHERE id = %s",
+            (delivery_pick.id,),
+        )
+        self.env["stock.move"].invalidate_cache(fnames=["estimated_shipping_weight"])
+        self.env["stock.picking"].invalidate_cache(fnames=["estimated_shipping_weight"])
+        self.assertFalse(delivery_pick.estimated_shipping_weight)
+        self.env["stock.move"]._init_estimated_shipping_weight()
+        self.assertAlmostEqual(delivery_pick.estimated_shipping_weight, 30.0)
+        self.assertIn(
+            delivery_pick,
+            self.env["stock.picking"].search(
+                [("estimated_shipping_weight", ">", 20.0)]
+            ),
+        )
+
+    def test_preferred_carriers_by_picking(self):
+        """
+        The preferred carriers of many pickings are resolved at once, with
+        the same result as for each picking
+        """
+        self.env["stock.quant"]._update_available_quantity(
+            self.product, self.loc_stock, 10
+        )
+        order1 = self._create_sale_order()
+        self._update_order_line_qty(order1, 1)
+        order1.action_confirm()
+        order2 = self._create_sale_order()
+        self._update_order_line_qty(order2, 3)
+        order2.action_confirm()
+        order3 = self._create_sale_order()
+        self._update_order_line_qty(order3, 5)
+        order3.action_confirm()
+        pickings = order1.picking_ids | order2.picking_ids | order3.picking_ids
+        pickings.filtered(lambda pick: pick.sale_id == order3).priority = "3"
+        carriers = pickings._get_preferred_carriers_by_picking()
+        for picking in pickings:
+            self.assertEqual(carriers[picking], picking.get_preferred_carriers())
+        pickings._add_preferred_carriers()
+        self.assertEqual(order1.picking_ids.carrier_id, self.normal_delivery_carrier)
+        self.assertEqual(order2.picking_ids.carrier_id, self.the_poste_carrier)
+        self.assertEqual(order3.picking_ids.carrier_id, self.super_fast_carrier)
+
+    def test_picking_domain_predicate(self):
+        """
+        Simple picking domains are evaluated in memory with the same result
+        as a search, the others are evaluated with a search
+        """
+        self.env["stock.quant"]._update_available_quantity(
+            self.product, self.loc_stock, 10
+        )
+        order1 = self._create_sale_order()
+        order1.action_confirm()
+        order2 = self._create_sale_order()
+        order2.action_confirm()
+        pickings = order1.picking_ids | order2.picking_ids
+        order2.picking_ids.write(
+            {"priority": "3", "carrier_id": self.the_poste_carrier.id}
+        )
+        preference_model = self.env["delivery.carrier.preference"]
+        preference = preference_model.search([], limit=1)
+        domains = [
+            "[]",
+            "[('priority', '=', '3')]",
+            "[('priority', 'in', ['0', '1'])]",
+            "['!', ('carrier_id', '=', False)]",
+            "['|', ('carrier_id', '=', %d), ('priority', '!=', '3')]"
+            % self.the_poste_carrier.id,
+            "[('printed', '=', False), ('move_type', '=', 'direct')]",
+        ]
+        for picking_domain in domains:
+            self.assertIsNotNone(
+                preference_model._get_picking_domain_predicate(picking_domain)
+            )
+            preference.picking_domain = picking_domain
+            self.assertEqual(
+                pickings._filter_picking_domain_valid(preference),
+                pickings.search(
+                    [("id", "in", pickings.ids)] + safe_eval(picking_domain)
+                ),
+            )
+        self.assertIsNone(
+            preference_model._get_picking_domain_predicate(
+                "[('partner_id.name', '=', 'Nope')]"
+            )
+        )
+        preference.picking_domain = "[('partner_id.name', '=', 'Nope')]"
+        self.assertFalse(pickings._filter_picking_domain_valid(preference))
+
+    def test_delivery_release_available_to_promise_many_groups(self):
+        """
+        With 4 available to promise and 2 orders of 3 with carrier 'super
+        fast', the first delivery is released with 'the poste' and the second
+        one with 'normal', only the backorder of the second one gets back its
+        original group and carrier
+        """
+        self.env["stock.quant"]._update_available_quantity(
+            self.product, self.loc_stock, 4
+        )
+        orders = self.env["sale.order"]
+        for __ in range(2):
+            order = self._create_sale_order()
+            self._update_order_line_qty(order, 3)
+            self._add_shipping_on_order(order)
+            order.action_confirm()
+            orders |= order
+        order1, order2 = orders
+        original_group = order2.picking_ids.group_id
+        (order1.picking_ids | order2.picking_ids).release_available_to_promise()
+        delivery_pick1 = order1.picking_ids.filtered(lambda pick: not pick.need_release)
+        self.assertEqual(delivery_pick1.carrier_id, self.the_poste_carrier)
+        self.assertEqual(delivery_pick1.group_id.carrier_id, self.the_poste_carrier)
+        self.assertFalse(delivery_pick1.backorder_ids)
+        delivery_pick2 = order2.picking_ids.filtered(lambda pick: pick.printed)
+        self.assertEqual(delivery_pick2.carrier_id, self.normal_delivery_carrier)
+        self.assertEqual(
+            delivery_pick2.group_id.carrier_id, self.normal_delivery_carrier
+        )
+        backorder = delivery_pick2.backorder_ids
+        self.assertEqual(backorder.group_id, original_group)
+        self.assertEqual(backorder.carrier_id, self.super_fast_carrier)
+
+    def test_preferences_for_weight(self):
+        """
+        The preferences are looked up by weight band in the index of the
+        company, which is refreshed when a preference is written
+        """
+        preference_model = self.env["delivery.carrier.preference"]
+        preferences = preference_model.search(
+            [("company_id", "=", self.env.company.id)]
+        )
+        for weight in (0.0, 10.0, 20.0, 20.5, 40.0, 50.0):
+            self.assertEqual(
+                preference_model._get_preferences_for_weight(self.env.company, weight),
+                preferences.filtered(
+                    lambda pref: not pref.max_weight or pref.max_weight >= weight
+                ),
+            )
+        preferences.filtered(
+            lambda pref: pref.carrier_id == self.the_poste_carrier
+        ).max_weight = 60.0
+        self.assertEqual(
+            preference_model._get_preferences_for_weight(
+                self.env.company, 50.0
+            ).carrier_id,
+            self.the_poste_carrier
+            | self.super_fast_carrier
+            | self.free_delivery_carrier,
+        )
+
+    def test_estimated_shipping_weight_refresh_stock(self):
+        """
+        The estimated shipping weight follows the stock and the moves with a
+        higher priority created afterwards
+        """
+        self.env["stock.quant"]._update_available_quantity(
+            self.product, self.loc_stock, 3
+        )
+        order1 = self._create_sale_order()
+        self._update_order_line_qty(order1, 5)
+        order1.action_confirm()
+        delivery_pick = order1.picking_ids
+        self.assertAlmostEqual(delivery_pick.estimated_shipping_weight, 30.0)
+        self.env["stock.quant"]._update_available_quantity(
+            self.product, self.loc_stock, 2
+        )
+        self.assertAlmostEqual(delivery_pick.estimated_shipping_weight, 50.0)
+        order2 = self._create_sale_order()
+        order2.date_order = "2019-01-01 00:00:00"
+        self._update_order_line_qty(order2, 4)
+        order2.action_confirm()
+        self.assertAlmostEqual(order2.picking_ids.estimated_shipping_weight, 40.0)
+        self.assertAlmostEqual(delivery_pick.estimated_shipping_weight, 10.0)
+
+    def test_preferences_for_weight_carrier_unlink(self):
+        """
+        The preferences deleted with their carrier are removed from the index
+        """
+        preference_model = self.env["delivery.carrier.preference"]
+        carrier = self.super_fast_carrier.copy({"name": "Short-lived carrier"})
+        preference = preference_model.create(
+            {"sequence": 50, "preference": "carrier", "carrier_id": carrier.id}
+        )
+        self.assertIn(
+            preference,
+            preference_model._get_preferences_for_weight(self.env.company, 50.0),
+        )
+        carrier.unlink()
+        self.assertFalse(preference.exists())
+        preferences = preference_model._get_preferences_for_weight(
+            self.env.company, 50.0
+        )
+        self.assertNotIn(preference.id, preferences.ids)
+        # the name of the preferences is read from their carrier
+        self.assertTrue(all(preferences.mapped("name")))
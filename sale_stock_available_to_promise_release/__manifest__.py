@@ -8,7 +8,7 @@
     "author": "Camptocamp,Odoo Community Association (OCA)",
     "category": "Stock Management",
     "depends": ["sale_stock", "stock_available_to_promise_release"],
-    "data": [],
+    "data": ["views/sale_order_views.xml"],
     "installable": True,
     "license": "AGPL-3",
     "application": False,
@@ -0,0 +1,30 @@
+# Copyright 2020 Camptocamp (https://www.camptocamp.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, fields, models
+
+
+class SaleOrder(models.Model):
+    _inherit = "sale.order"
+
+    projected_release_date = fields.Datetime(
+        compute="_compute_projected_release_date",
+        help="Date when all the lines are expected to be available to "
+        "promise. Empty when the planned receipts are not enough for a line.",
+    )
+
+    @api.depends(
+        "order_line.projected_release_date", "order_line.projected_release_missing"
+    )
+    def _compute_projected_release_date(self):
+        # compute the dates of the lines of all the orders at once
+        self.order_line.mapped("projected_release_date")
+        for order in self:
+            lines = order.order_line
+            line_dates = [
+                date for date in lines.mapped("projected_release_date") if date
+            ]
+            if line_dates and not any(lines.mapped("projected_release_missing")):
+                order.projected_release_date = max(line_dates)
+            else:
+                order.projected_release_date = False
@@ -1,13 +1,105 @@
 # Copyright 2019 Camptocamp (https://www.camptocamp.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from odoo import models
+from odoo import api, fields, models
+from odoo.tools import float_compare
 
 
 class SaleOrderLine(models.Model):
     _inherit = "sale.order.line"
 
+    projected_release_date = fields.Datetime(
+        compute="_compute_projected_release_date",
+        help="Date when the quantity to deliver is expected to be available "
+        "to promise, from the stock and the planned receipts, after the "
+        "deliveries with a higher priority. Empty when the quantity has "
+        "been released or when the planned receipts are not enough.",
+    )
+    projected_release_missing = fields.Boolean(
+        compute="_compute_projected_release_date",
+        help="Technical field: the planned receipts are not enough to "
+        "release the line.",
+    )
+
     def _prepare_procurement_values(self, group_id=False):
         values = super()._prepare_procurement_values(group_id)
         values["date_priority"] = self.order_id.date_order
         return values
+
+    @api.depends(
+        "product_id",
+        "product_uom_qty",
+        "product_uom",
+        "order_id.warehouse_id",
+        "move_ids.need_release",
+    )
+    def _compute_projected_release_date(self):
+        dates = self._get_projected_release_dates()
+        for line in self:
+            line.projected_release_date = dates.get(line.id) or False
+            line.projected_release_missing = line.id in dates and not dates[line.id]
+
+    def _get_projected_release_dates(self):
+        """Compute the projected release dates of lines in a batch
+
+        A line can be released when the stock covers its quantity and the
+        quantities promised to the deliveries with a higher priority. The
+        lines of quotations come after all the existing deliveries. The
+        missing quantity is taken from the planned receipts by expected
+        date. The stock, the promised quantities and the receipts are read
+        for all the lines at once.
+
+        Return a dict ``{line id: date}``, the date is None when the planned
+        receipts do not cover the line. The lines which have nothing to
+        release are not in the result.
+        """
+        Move = self.env["stock.move"]
+        lines = self.filtered(
+            lambda line: line.id
+            and line.state != "cancel"
+            and line.product_id.type == "product"
+            and line.order_id.warehouse_id
+        )
+        moves = lines.move_ids.filtered(lambda move: move._is_release_needed())
+        previous_promised = moves._get_previous_promised_qty()
+        quotation_lines = lines.filtered(lambda line: line.state in ("draft", "sent"))
+        promised = Move._get_promised_qty_by_product_warehouse(
+            quotation_lines.product_id, quotation_lines.order_id.warehouse_id
+        )
+        # quantity which must be in stock to release each line
+        needed_quantities = {}
+        for line in lines:
+            if line in quotation_lines:
+                warehouse = line.order_id.warehouse_id
+                needed_quantities[line] = promised.get(
+                    (line.product_id.id, warehouse.id), 0.0
+                ) + line.product_uom._compute_quantity(
+                    line.product_uom_qty, line.product_id.uom_id
+                )
+                continue
+            line_moves = line.move_ids & moves
+            if line_moves:
+                needed_quantities[line] = max(
+                    previous_promised.get(move.id, 0.0) + move.product_qty
+                    for move in line_moves
+                )
+
+        locations = lines.order_id.warehouse_id.lot_stock_id
+        on_hand = Move._get_stock_on_hand_snapshot(lines.product_id, locations)
+        incoming = Move._get_incoming_qty_by_date(lines.product_id, locations)
+        now = fields.Datetime.now()
+        result = {}
+        for line, needed_quantity in needed_quantities.items():
+            rounding = line.product_id.uom_id.rounding
+            key = (line.product_id.id, line.order_id.warehouse_id.lot_stock_id.id)
+            missing = needed_quantity - on_hand.get(key, 0.0)
+            result[line.id] = None
+            if float_compare(missing, 0, precision_rounding=rounding) <= 0:
+                result[line.id] = now
+                continue
+            for date, quantity in incoming.get(key, []):
+                missing -= quantity
+                if float_compare(missing, 0, precision_rounding=rounding) <= 0:
+                    result[line.id] = max(date, now)
+                    break
+        return result
@@ -0,0 +1 @@
+from . import test_projected_release_date
@@ -0,0 +1,93 @@
+# Copyright 2020 Camptocamp (https://www.camptocamp.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from datetime import datetime
+
+from freezegun import freeze_time
+
+from odoo.addons.stock_available_to_promise_release.tests.common import (
+    PromiseReleaseCommonCase,
+)
+
+
+@freeze_time("2020-01-01 10:00:00")
+class TestProjectedReleaseDate(PromiseReleaseCommonCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        cls.now = datetime(2020, 1, 1, 10, 0, 0)
+        cls.receipt_date = datetime(2020, 1, 10, 8, 0, 0)
+
+    def _create_order(self, quantity):
+        return self.env["sale.order"].create(
+            {
+                "partner_id": self.partner_delta.id,
+                "warehouse_id": self.wh.id,
+                "order_line": [
+                    (
+                        0,
+                        0,
+                        {
+                            "name": self.product1.name,
+                            "product_id": self.product1.id,
+                            "product_uom_qty": quantity,
+                            "product_uom": self.uom_unit.id,
+                            "price_unit": 10.0,
+                        },
+                    )
+                ],
+            }
+        )
+
+    def _create_receipt(self, quantity):
+        move = self.env["stock.move"].create(
+            {
+                "name": "receipt",
+                "product_id": self.product1.id,
+                "product_uom_qty": quantity,
+                "product_uom": self.uom_unit.id,
+                "location_id": self.env.ref("stock.stock_location_suppliers").id,
+                "location_dest_id": self.loc_stock.id,
+                "date_expected": self.receipt_date,
+            }
+        )
+        move._action_confirm()
+        return move
+
+    def _assert_projected_release_date(self, order, date):
+        self.assertEqual(order.order_line.projected_release_date, date)
+        self.assertEqual(order.projected_release_date, date)
+
+    def test_covered_by_stock(self):
+        self._update_qty_in_location(self.loc_bin1, self.product1, 10.0)
+        order = self._create_order(5)
+        self._assert_projected_release_date(order, self.now)
+        order.action_confirm()
+        self.assertTrue(order.order_line.move_ids.need_release)
+        order.invalidate_cache()
+        self._assert_projected_release_date(order, self.now)
+
+    def test_covered_by_receipt(self):
+        self._update_qty_in_location(self.loc_bin1, self.product1, 2.0)
+        self._create_receipt(10)
+        order = self._create_order(5)
+        self._assert_projected_release_date(order, self.receipt_date)
+        order.action_confirm()
+        order.invalidate_cache()
+        self._assert_projected_release_date(order, self.receipt_date)
+        # a quotation comes after the confirmed order: 2 in stock, 5 promised
+        # and 10 received
+        order2 = self._create_order(7)
+        self._assert_projected_release_date(order2, self.receipt_date)
+
+    def test_not_covered(self):
+        self._update_qty_in_location(self.loc_bin1, self.product1, 2.0)
+        self._create_receipt(10)
+        order = self._create_order(20)
+        self._assert_projected_release_date(order, False)
+        self.assertTrue(order.order_line.projected_release_missing)
+        order.action_confirm()
+        order.invalidate_cache()
+        self._assert_projected_release_date(order, False)
+        self.assertTrue(order.order_line.projected_release_missing)
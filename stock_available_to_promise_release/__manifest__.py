@@ -9,11 +9,20 @@
     "category": "Stock Management",
     "depends": ["stock"],
     "data": [
+        "security/ir.model.access.csv",
+        "data/ir_sequence_data.xml",
         "views/stock_move_views.xml",
         "views/stock_picking_views.xml",
         "views/stock_location_route_views.xml",
+        "views/stock_release_run_views.xml",
+        "views/stock_release_wave_views.xml",
+        "views/stock_release_statistics_views.xml",
+        "views/stock_picking_type_views.xml",
+        "views/stock_warehouse_views.xml",
         "views/res_config_settings.xml",
         "wizards/stock_move_release_views.xml",
+        "wizards/stock_release_plan_views.xml",
+        "data/ir_cron_data.xml",
     ],
     "installable": True,
     "license": "AGPL-3",
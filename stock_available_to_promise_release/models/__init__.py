@@ -1,6 +1,13 @@
+from . import product_product
 from . import stock_move
 from . import stock_location_route
 from . import stock_picking
+from . import stock_picking_type
+from . import stock_quant
+from . import stock_release_run
+from . import stock_release_statistics
+from . import stock_release_wave
 from . import stock_rule
 from . import res_company
 from . import res_config_settings
+from . import stock_warehouse
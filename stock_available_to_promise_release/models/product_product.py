@@ -0,0 +1,118 @@
+# Copyright 2020 Camptocamp (https://www.camptocamp.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+import threading
+import time
+from collections import OrderedDict
+
+from odoo import api, fields, models
+from odoo.tools import float_round
+
+# In-process cache of the ordered available to promise of products:
+# {dbname: OrderedDict({(company id, date priority, product id, warehouse id):
+# (expiry time, quantity)})}. It is emptied when quants or moves are changed
+# in this process, the other processes see the changes after the TTL. The
+# entries are ordered by insertion, so the expired ones are dropped from the
+# front, and at most PROMISABLE_CACHE_SIZE entries are kept per database.
+_promisable_cache = {}
+_promisable_cache_lock = threading.RLock()
+PROMISABLE_CACHE_SIZE = 10000
+
+
+class ProductProduct(models.Model):
+    _inherit = "product.product"
+
+    last_release_date = fields.Datetime(
+        readonly=True,
+        copy=False,
+        help="Technical field: date of the last release of the product, "
+        "written when a release locks the product.",
+    )
+
+    def _get_ordered_available_to_promise_by_warehouse(
+        self, warehouses, date_priority=None
+    ):
+        """Return the quantities which can be promised in warehouses
+
+        Return a dict ``{(product id, warehouse id): quantity}``: the
+        quantity in stock minus the quantities promised to the moves which
+        would be served before a new move with the priority
+        ``date_priority`` (after all the moves if None). It is computed for
+        all the products and warehouses at once and kept in a short-lived
+        cache, see ``_promisable_cache_ttl``.
+        """
+        dbname = self.env.cr.dbname
+        company_id = self.env.company.id
+        now = time.monotonic()
+        result = {}
+        missing_product_ids = set()
+        with _promisable_cache_lock:
+            cache = _promisable_cache.get(dbname, {})
+            for product in self:
+                for warehouse in warehouses:
+                    key = (company_id, date_priority, product.id, warehouse.id)
+                    expiry, quantity = cache.get(key, (0, 0.0))
+                    if expiry > now:
+                        result[(product.id, warehouse.id)] = quantity
+                    else:
+                        cache.pop(key, None)
+                        missing_product_ids.add(product.id)
+        if not missing_product_ids:
+            return result
+
+        products = self.browse(missing_product_ids)
+        computed = products._compute_ordered_available_to_promise_by_warehouse(
+            warehouses, date_priority=date_priority
+        )
+        result.update(computed)
+        expiry = now + self._promisable_cache_ttl()
+        with _promisable_cache_lock:
+            cache = _promisable_cache.setdefault(dbname, OrderedDict())
+            for (product_id, warehouse_id), quantity in computed.items():
+                key = (company_id, date_priority, product_id, warehouse_id)
+                cache.pop(key, None)
+                cache[key] = (expiry, quantity)
+            self._evict_promisable_cache(cache, now)
+        return result
+
+    @api.model
+    def _evict_promisable_cache(self, cache, now):
+        """Drop the expired entries and the oldest ones above the size"""
+        while cache:
+            key, (expiry, __) = next(iter(cache.items()))
+            if expiry > now and len(cache) <= PROMISABLE_CACHE_SIZE:
+                break
+            del cache[key]
+
+    def _compute_ordered_available_to_promise_by_warehouse(
+        self, warehouses, date_priority=None
+    ):
+        Move = self.env["stock.move"]
+        on_hand = Move._get_stock_on_hand_snapshot(self, warehouses.lot_stock_id)
+        promised = Move._get_promised_qty_by_product_warehouse(
+            self, warehouses, date_priority=date_priority
+        )
+        result = {}
+        for product in self:
+            for warehouse in warehouses:
+                available = on_hand.get(
+                    (product.id, warehouse.lot_stock_id.id), 0.0
+                ) - promised.get((product.id, warehouse.id), 0.0)
+                result[(product.id, warehouse.id)] = max(
+                    float_round(available, precision_rounding=product.uom_id.rounding),
+                    0.0,
+                )
+        return result
+
+    @api.model
+    def _promisable_cache_ttl(self):
+        """Number of seconds the promisable quantities are kept in cache"""
+        return int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("stock_available_to_promise_release.promisable_cache_ttl", 10)
+        )
+
+    @api.model
+    def _invalidate_promisable_cache(self):
+        with _promisable_cache_lock:
+            _promisable_cache.pop(self.env.cr.dbname, None)
@@ -11,3 +11,18 @@ class Company(models.Model):
         help="Compute promised quantities for order planned to be shipped "
         "until this number of days from today.",
     )
+    stock_release_chunk_size = fields.Integer(
+        default=100,
+        help="Number of moves released in a transaction by the background "
+        "release runs.",
+    )
+    stock_release_on_stock_arrival = fields.Boolean(
+        string="Release on Stock Arrival",
+        help="When products enter the stock of a warehouse, queue the moves "
+        "to release of these products in background.",
+    )
+    stock_release_statistics = fields.Boolean(
+        string="Record Release Statistics",
+        help="Record the duration and number of queries of each phase of "
+        "the releases.",
+    )
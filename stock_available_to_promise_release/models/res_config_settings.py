@@ -11,3 +11,16 @@ class ResConfigSettings(models.TransientModel):
     stock_reservation_horizon = fields.Integer(
         related="company_id.stock_reservation_horizon", readonly=False,
     )
+    stock_release_chunk_size = fields.Integer(
+        related="company_id.stock_release_chunk_size", readonly=False,
+    )
+    stock_release_on_stock_arrival = fields.Boolean(
+        string="Release on Stock Arrival",
+        related="company_id.stock_release_on_stock_arrival",
+        readonly=False,
+    )
+    stock_release_statistics = fields.Boolean(
+        string="Record Release Statistics",
+        related="company_id.stock_release_statistics",
+        readonly=False,
+    )
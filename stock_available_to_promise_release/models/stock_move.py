@@ -1,14 +1,52 @@
 # Copyright 2019 Camptocamp (https://www.camptocamp.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from odoo import api, fields, models
+import logging
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
 from odoo.osv import expression
-from odoo.tools import date_utils, float_compare
+from odoo.tools import date_utils, float_compare, float_round
+from odoo.tools.sql import column_exists, create_column, index_exists
+
+from .stock_release_statistics import ReleaseProfiler
+
+_logger = logging.getLogger(__name__)
+
+# first key of the advisory locks taken on products during a release
+RELEASE_LOCK_KEY = 1769201
+# states of the released moves which still promise their quantity
+PROMISE_STATES = ("waiting", "confirmed", "partially_available", "assigned")
+# fields of the moves changing the ordered available to promise
+ORDERED_AVAILABLE_TO_PROMISE_FIELDS = {
+    "product_id",
+    "product_uom_qty",
+    "product_uom",
+    "location_id",
+    "warehouse_id",
+    "picking_type_id",
+    "date_priority",
+    "date_expected",
+    "need_release",
+    "state",
+}
 
 
 class StockMove(models.Model):
     _inherit = "stock.move"
 
+    ReleasePlan = namedtuple(
+        "ReleasePlan",
+        # available_qty is the ordered available to promise of the move,
+        # release_qty the quantity released and remaining_qty the quantity
+        # left to release. outcome is "full" (released), "partial" (split),
+        # "nothing" (no available to promise) or "all_at_once" (not released
+        # because the picking must be shipped at once).
+        "available_qty release_qty remaining_qty outcome",
+    )
+
     date_priority = fields.Datetime(
         string="Priority Date",
         index=True,
@@ -24,11 +62,82 @@ class StockMove(models.Model):
         " to older promised operations.",
     )
     need_release = fields.Boolean(index=True,)
+    release_wave_id = fields.Many2one(
+        "stock.release.wave", index=True, readonly=True, copy=False
+    )
+    promised_unreserved_qty = fields.Float(
+        string="Promised Unreserved Quantity",
+        compute="_compute_promised_unreserved_qty",
+        store=True,
+        digits=0,
+        help="Technical field: quantity promised by the move and not reserved "
+        "yet, summed to compute the quantity promised to older operations.",
+    )
+
+    def _auto_init(self):
+        # Create the column beforehand so the ORM does not compute the
+        # promised unreserved quantity of every move ever done when the
+        # module is installed, only the open moves need it. The ledger is
+        # filled once the columns of the module, such as ``need_release``,
+        # have been created.
+        new_ledger = not column_exists(
+            self.env.cr, "stock_move", "promised_unreserved_qty"
+        )
+        if new_ledger:
+            create_column(
+                self.env.cr, "stock_move", "promised_unreserved_qty", "numeric"
+            )
+        res = super()._auto_init()
+        if new_ledger:
+            self._rebuild_promise_ledger()
+        return res
 
+    def init(self):
+        # Partial indexes for the lookup of the quantities promised to the
+        # other moves of a product in a warehouse: the moves to release,
+        # ordered by priority, and the released moves not done yet. Their
+        # predicates must be implied by the WHERE clause of the lookup.
+        indexes = {
+            "stock_move_promise_need_release_index": (
+                "product_id, warehouse_id, date_priority",
+                "need_release IS TRUE",
+            ),
+            "stock_move_promise_released_index": (
+                "product_id, warehouse_id",
+                "state IN ({})".format(
+                    ", ".join("'{}'".format(state) for state in PROMISE_STATES)
+                ),
+            ),
+        }
+        for name, (columns, predicate) in indexes.items():
+            if not index_exists(self.env.cr, name):
+                # pylint: disable=sql-injection
+                self.env.cr.execute(
+                    "CREATE INDEX {} ON stock_move ({}) WHERE {}".format(
+                        name, columns, predicate
+                    )
+                )
+
+    @api.depends("product_qty", "product_uom", "move_line_ids.product_qty")
+    def _compute_promised_unreserved_qty(self):
+        for move in self:
+            move.promised_unreserved_qty = max(
+                move.product_qty - move.reserved_availability, 0.0
+            )
+
+    # The ordered available to promise depends on the stock and on the other
+    # moves, it has no dependencies: its value is kept in the cache of the
+    # transaction, so it is computed once for the steps of a release, until
+    # ``_invalidate_ordered_available_to_promise`` is called when the stock,
+    # the moves or their reservations change.
     @api.depends()
     def _compute_ordered_available_to_promise(self):
+        quantities = self._get_ordered_available_to_promise()
         for move in self:
-            move.ordered_available_to_promise = move._ordered_available_to_promise()
+            if move.id in quantities:
+                move.ordered_available_to_promise = quantities[move.id]
+            else:
+                move.ordered_available_to_promise = move._ordered_available_to_promise()
 
     def _should_compute_ordered_available_to_promise(self):
         return (
@@ -38,11 +147,89 @@ class StockMove(models.Model):
             and not self.location_id.should_bypass_reservation()
         )
 
+    @api.model
+    def _invalidate_ordered_available_to_promise(self):
+        """Drop the ordered available to promise of all the moves from cache"""
+        self.invalidate_cache(fnames=["ordered_available_to_promise"])
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env["product.product"]._invalidate_promisable_cache()
+        self._invalidate_ordered_available_to_promise()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if ORDERED_AVAILABLE_TO_PROMISE_FIELDS.intersection(vals):
+            self.env["product.product"]._invalidate_promisable_cache()
+            self._invalidate_ordered_available_to_promise()
+        return super().write(vals)
+
+    def _action_assign(self):
+        res = super()._action_assign()
+        self._invalidate_ordered_available_to_promise()
+        return res
+
+    def _do_unreserve(self):
+        res = super()._do_unreserve()
+        self._invalidate_ordered_available_to_promise()
+        return res
+
     def _action_cancel(self):
         super()._action_cancel()
         self.write({"need_release": False})
         return True
 
+    def _action_done(self, cancel_backorder=False):
+        done_moves = super()._action_done(cancel_backorder=cancel_backorder)
+        self._invalidate_ordered_available_to_promise()
+        done_moves._release_enqueue_on_stock_arrival()
+        return done_moves
+
+    def _release_enqueue_on_stock_arrival(self):
+        """Queue the moves to release of the products entering a stock
+
+        When the done moves bring products in the stock of a warehouse (a
+        receipt, an inventory adjustment...), the moves which need a release
+        for these products in this warehouse are queued to be released in
+        background, by priority date. Only for the companies with the
+        option activated.
+        """
+        moves_by_location = defaultdict(list)
+        for move in self:
+            if move.state != "done":
+                continue
+            if not move.company_id.stock_release_on_stock_arrival:
+                continue
+            moves_by_location[move.location_dest_id].append(move)
+        product_ids_by_warehouse = defaultdict(set)
+        # the warehouse is searched once per destination location
+        for location_dest, location_moves in moves_by_location.items():
+            warehouse = location_dest.get_warehouse()
+            if not warehouse:
+                continue
+            stock_path = warehouse.lot_stock_id.parent_path
+            if not location_dest.parent_path.startswith(stock_path):
+                continue
+            for move in location_moves:
+                if (move.location_id.parent_path or "").startswith(stock_path):
+                    # moved inside the stock
+                    continue
+                product_ids_by_warehouse[warehouse.id].add(move.product_id.id)
+        if not product_ids_by_warehouse:
+            return
+        moves = self.browse()
+        for warehouse_id, product_ids in product_ids_by_warehouse.items():
+            moves |= self.search(
+                [
+                    ("need_release", "=", True),
+                    ("state", "in", ("confirmed", "waiting")),
+                    ("warehouse_id", "=", warehouse_id),
+                    ("product_id", "in", list(product_ids)),
+                ],
+                order="date_priority, id",
+            )
+        self.env["stock.release.run"]._enqueue_on_stock_arrival(moves)
+
     def _ordered_available_to_promise(self):
         if not self._should_compute_ordered_available_to_promise():
             return 0.0
@@ -61,16 +248,44 @@ class StockMove(models.Model):
         }
 
     def _promise_reservation_horizon(self):
-        return self.env.company.sudo().stock_reservation_horizon
+        return self._promise_reservation_horizons(self.warehouse_id).get(
+            self.warehouse_id.id, 0
+        )
 
     def _promise_reservation_horizon_date(self):
-        horizon = self._promise_reservation_horizon()
-        if horizon:
-            # start from end of today and add horizon days
-            return date_utils.add(
-                date_utils.end_of(fields.Datetime.today(), "day"), days=horizon
+        return self._promise_reservation_horizon_dates(self.warehouse_id).get(
+            self.warehouse_id.id
+        )
+
+    @api.model
+    def _promise_reservation_horizons(self, warehouses):
+        """Return the horizon in days of warehouses ``{warehouse id: days}``
+
+        The horizon of a warehouse is the one of its company when it is not
+        set on the warehouse. The key ``False`` gives the horizon of the
+        moves without warehouse, the one of the current company.
+        """
+        horizons = {False: self.env.company.sudo().stock_reservation_horizon}
+        for warehouse in warehouses.sudo():
+            horizons[warehouse.id] = (
+                warehouse.stock_reservation_horizon
+                or warehouse.company_id.stock_reservation_horizon
             )
-        return None
+        return horizons
+
+    @api.model
+    def _promise_reservation_horizon_dates(self, warehouses):
+        """Return the horizon dates of warehouses ``{warehouse id: date}``
+
+        The date is None when the warehouse has no horizon.
+        """
+        horizons = self._promise_reservation_horizons(warehouses)
+        # start from end of today and add horizon days
+        end_of_today = date_utils.end_of(fields.Datetime.today(), "day")
+        return {
+            warehouse_id: date_utils.add(end_of_today, days=days) if days else None
+            for warehouse_id, days in horizons.items()
+        }
 
     def _previous_promised_quantity_domain(self):
         """Lookup for product promised qty in the same warehouse.
@@ -97,11 +312,7 @@ class StockMove(models.Model):
         # and is not canceled or done
         domain_released = [
             ("need_release", "=", False),
-            (
-                "state",
-                "in",
-                ("waiting", "confirmed", "partially_available", "assigned"),
-            ),
+            ("state", "in", PROMISE_STATES),
         ]
         # NOTE: this domain might be suboptimal as we may lookup too many moves.
         # If we face performance issues, this is a good candidate to debug.
@@ -110,23 +321,448 @@ class StockMove(models.Model):
         )
 
     def _previous_promised_qty(self):
-        previous_moves = self.search(
+        # the quantities are summed from the promise ledger,
+        # see ``promised_unreserved_qty``
+        result = self.read_group(
             expression.AND(
                 # TODO: `!=` could be suboptimal, consider filter out on recordset
                 [self._previous_promised_quantity_domain(), [("id", "!=", self.id)]]
             ),
+            ["promised_unreserved_qty"],
+            [],
         )
-        # TODO: consider sum via SQL
-        promised_qty = sum(
-            previous_moves.mapped(
-                lambda move: max(move.product_qty - move.reserved_availability, 0.0)
+        return (result and result[0]["promised_unreserved_qty"]) or 0.0
+
+    @api.model
+    def _rebuild_promise_ledger(self):
+        """Recompute the promised unreserved quantity of the open moves
+
+        The promise ledger (field ``promised_unreserved_qty``) is maintained
+        by the ORM, this method is meant to be called from a shell if it has
+        been altered by SQL queries (see ``_check_promise_ledger``). The
+        reserved quantity is converted in the UoM of the move, as done by
+        the computed field ``reserved_availability``.
+        """
+        self.env["base"].flush()
+        self.env.cr.execute(
+            """
+            UPDATE stock_move
+            SET promised_unreserved_qty = computed.qty
+            FROM (
+                SELECT move.id,
+                       GREATEST(
+                           move.product_qty - COALESCE(
+                               ROUND(
+                                   reserved.qty
+                                   / product_uom.factor
+                                   * move_uom.factor
+                                   / move_uom.rounding
+                               ) * move_uom.rounding,
+                               0
+                           ),
+                           0
+                       ) AS qty
+                FROM stock_move move
+                INNER JOIN product_product product
+                ON product.id = move.product_id
+                INNER JOIN product_template template
+                ON template.id = product.product_tmpl_id
+                INNER JOIN uom_uom product_uom
+                ON product_uom.id = template.uom_id
+                INNER JOIN uom_uom move_uom
+                ON move_uom.id = move.product_uom
+                LEFT JOIN LATERAL (
+                    SELECT SUM(move_line.product_qty) AS qty
+                    FROM stock_move_line move_line
+                    WHERE move_line.move_id = move.id
+                ) reserved
+                ON TRUE
+                WHERE move.need_release IS TRUE
+                OR move.state NOT IN ('done', 'cancel')
+            ) computed
+            WHERE computed.id = stock_move.id
+            """
+        )
+        _logger.info("promise ledger rebuilt for %d stock moves", self.env.cr.rowcount)
+        self.invalidate_cache(fnames=["promised_unreserved_qty"])
+
+    @api.model
+    def _check_promise_ledger(self, moves=None):
+        """Check the promise ledger against the moves reservations
+
+        The quantity promised to older operations is the sum of the
+        ``promised_unreserved_qty`` of the moves matching
+        ``_previous_promised_quantity_domain``: it is consistent as long as
+        each of these moves has the same stored quantity as the one computed
+        from its product quantity and ``reserved_availability``.
+
+        Check the given moves or all the moves which can be part of a
+        promise. Return a dict ``{move: (stored qty, expected qty)}`` of
+        the inconsistent moves.
+        """
+        if moves is None:
+            moves = self.search(
+                [
+                    "|",
+                    ("need_release", "=", True),
+                    ("state", "not in", ("done", "cancel")),
+                ]
+            )
+        inconsistencies = {}
+        for move in moves:
+            expected = max(move.product_qty - move.reserved_availability, 0.0)
+            if float_compare(
+                move.promised_unreserved_qty,
+                expected,
+                precision_rounding=move.product_id.uom_id.rounding,
+            ):
+                inconsistencies[move] = (move.promised_unreserved_qty, expected)
+        for move, (stored, expected) in inconsistencies.items():
+            _logger.warning(
+                "promise ledger of stock move %d is %s instead of %s",
+                move.id,
+                stored,
+                expected,
             )
+        return inconsistencies
+
+    def _get_ordered_available_to_promise(self):
+        """Compute the ordered available to promise of many moves at once
+
+        Return a dict ``{move id: quantity}`` with the same values as
+        ``_ordered_available_to_promise`` called on each move. The stock is
+        read from a snapshot of the quants of all the products and the
+        promised quantities are computed with a single windowed query
+        partitioned by product and warehouse.
+
+        Moves without id or warehouse are not in the result, they must use
+        ``_ordered_available_to_promise``. So are the moves for which
+        ``_order_available_to_promise_qty_ctx`` is overridden with another
+        context than a ``location``, which the snapshot cannot read.
+        """
+        result = {}
+        moves = self.browse()
+        stock_location_ids = {}
+        for move in self:
+            if not move.id or not move.warehouse_id:
+                continue
+            if not move._should_compute_ordered_available_to_promise():
+                result[move.id] = 0.0
+                continue
+            qty_ctx = move._order_available_to_promise_qty_ctx()
+            if set(qty_ctx) != {"location"}:
+                continue
+            stock_location_ids[move.id] = qty_ctx["location"]
+            moves |= move
+        if not moves:
+            return result
+
+        on_hand = self._get_stock_on_hand_snapshot(
+            moves.product_id,
+            self.env["stock.location"].browse(set(stock_location_ids.values())),
         )
-        return promised_qty
+        previous_promised = moves._get_previous_promised_qty()
+        for move in moves:
+            move_available = on_hand.get(
+                (move.product_id.id, stock_location_ids[move.id]), 0.0
+            )
+            result[move.id] = max(
+                min(
+                    move_available - previous_promised.get(move.id, 0.0),
+                    move.product_qty,
+                ),
+                0.0,
+            )
+        return result
+
+    @api.model
+    def _get_stock_on_hand_snapshot(self, products, locations):
+        """Read the quantity on hand of products in locations
+
+        The quants of all the products in the locations and their children
+        are summed in a single grouped query, using the ``parent_path`` of
+        the locations. Return a dict ``{(product id, location id):
+        quantity}`` where the quantities are the same as the
+        ``qty_available`` of the products in the context of the locations.
+        """
+        if not products or not locations:
+            return {}
+        self.env["stock.quant"].flush(["product_id", "location_id", "quantity"])
+        self.env.cr.execute(
+            """
+            SELECT quant.product_id, location.id, SUM(quant.quantity)::float
+            FROM stock_location location
+            INNER JOIN stock_location child
+            ON child.parent_path LIKE location.parent_path || '%%'
+            INNER JOIN stock_quant quant
+            ON quant.location_id = child.id
+            WHERE location.id IN %s
+            AND quant.product_id IN %s
+            GROUP BY quant.product_id, location.id
+            """,
+            (tuple(locations.ids), tuple(products.ids)),
+        )
+        rounding = {product.id: product.uom_id.rounding for product in products}
+        return {
+            (product_id, location_id): float_round(
+                quantity, precision_rounding=rounding[product_id]
+            )
+            for product_id, location_id, quantity in self.env.cr.fetchall()
+        }
+
+    @api.model
+    def _get_promised_qty_by_product_warehouse(
+        self, products, warehouses, date_priority=None
+    ):
+        """Sum the quantities promised per product and warehouse
+
+        The quantities are the ones which a new move of the products in the
+        warehouses, with the priority ``date_priority``, would have to
+        deduct from the stock: the released moves and the moves to release
+        with a higher priority (all of them if ``date_priority`` is None),
+        within the horizon of the warehouses. Return a dict ``{(product id,
+        warehouse id): quantity}`` computed in a single grouped query.
+        """
+        if not products or not warehouses:
+            return {}
+        self.env["base"].flush()
+        horizon_cte, params = self._get_promise_horizon_cte(warehouses)
+        params.update(
+            {
+                "product_ids": tuple(products.ids),
+                "date_priority": date_priority,
+                "states": PROMISE_STATES,
+            }
+        )
+        # pylint: disable=sql-injection
+        self.env.cr.execute(
+            """
+            WITH {horizon_cte}
+            SELECT move.product_id,
+                   move.warehouse_id,
+                   SUM(COALESCE(move.promised_unreserved_qty, 0))::float
+            FROM stock_move move
+            JOIN horizon ON horizon.warehouse_id = move.warehouse_id
+            WHERE move.product_id IN %(product_ids)s
+            AND move.warehouse_id IN %(warehouse_ids)s
+            AND (
+                (
+                    move.need_release IS TRUE
+                    AND (
+                        %(date_priority)s::timestamp IS NULL
+                        OR move.date_priority < %(date_priority)s
+                    )
+                )
+                OR (move.need_release IS NOT TRUE AND move.state IN %(states)s)
+            )
+            AND (
+                horizon.horizon_date IS NULL
+                OR move.date_expected <= horizon.horizon_date
+            )
+            GROUP BY move.product_id, move.warehouse_id
+            """.format(
+                horizon_cte=horizon_cte
+            ),
+            params,
+        )
+        return {
+            (product_id, warehouse_id): quantity
+            for product_id, warehouse_id, quantity in self.env.cr.fetchall()
+        }
+
+    @api.model
+    def _get_incoming_qty_by_date(self, products, locations):
+        """Read the quantities planned to enter locations, by date
+
+        The moves counted come from outside the locations and their children
+        and bring products inside them. Return a dict ``{(product id,
+        location id): [(date expected, quantity), ...]}`` with the dates in
+        ascending order and the quantities in the UoM of the products.
+        """
+        if not products or not locations:
+            return {}
+        self.env["base"].flush()
+        self.env.cr.execute(
+            """
+            SELECT move.product_id,
+                   location.id,
+                   move.date_expected,
+                   SUM(move.product_qty)::float
+            FROM stock_move move
+            INNER JOIN stock_location dest ON dest.id = move.location_dest_id
+            INNER JOIN stock_location src ON src.id = move.location_id
+            INNER JOIN stock_location location
+            ON dest.parent_path LIKE location.parent_path || '%%'
+            AND src.parent_path NOT LIKE location.parent_path || '%%'
+            WHERE location.id IN %s
+            AND move.product_id IN %s
+            AND move.state NOT IN ('draft', 'done', 'cancel')
+            GROUP BY move.product_id, location.id, move.date_expected
+            ORDER BY move.date_expected
+            """,
+            (tuple(locations.ids), tuple(products.ids)),
+        )
+        result = defaultdict(list)
+        for product_id, location_id, date, quantity in self.env.cr.fetchall():
+            result[(product_id, location_id)].append((date, quantity))
+        return dict(result)
+
+    def _get_previous_promised_qty(self):
+        """Batch version of ``_previous_promised_qty``
+
+        Return a dict ``{move id: promised quantity}``. The moves matching
+        ``_previous_promised_quantity_domain`` are read in a single query
+        and the quantity promised to the moves with a higher priority is
+        a running sum of the promise ledger (``promised_unreserved_qty``)
+        ordered by ``date_priority``, partitioned by product and warehouse.
+        """
+        if not self:
+            return {}
+        self.env["base"].flush()
+        self.env.cr.execute(*self._get_previous_promised_qty_query())
+        return dict(self.env.cr.fetchall())
+
+    def _get_previous_promised_qty_query(self):
+        """Return the query and params of ``_get_previous_promised_qty``
+
+        The moves planned beyond the horizon of their warehouse promise
+        nothing, they are only read when their own promised quantity is
+        asked.
+        """
+        ledger_ctes, params = self._get_promise_ledger_ctes(
+            self.warehouse_id,
+            where="move.product_id IN %(product_ids)s",
+            keep="move.id IN %(move_ids)s",
+        )
+        query = """
+            WITH {ledger_ctes}
+            SELECT id, previous_qty::float
+            FROM ordered
+            WHERE id IN %(move_ids)s
+        """.format(
+            ledger_ctes=ledger_ctes
+        )
+        params.update(
+            {"product_ids": tuple(self.product_id.ids), "move_ids": tuple(self.ids)}
+        )
+        return query, params
+
+    @api.model
+    def _get_promise_horizon_cte(self, warehouses):
+        """Return the ``horizon`` CTE of the promise queries and its params
+
+        The CTE gives the horizon date (``horizon_date``) of each warehouse
+        (``warehouse_id``), NULL when the warehouse has no horizon. The
+        horizon dates are computed once per warehouse.
+        """
+        horizon_dates = self._promise_reservation_horizon_dates(warehouses)
+        cte = """
+            horizon AS (
+                SELECT *
+                FROM unnest(
+                    %(warehouse_ids_list)s::integer[],
+                    %(horizon_dates)s::timestamp[]
+                )
+                AS horizon (warehouse_id, horizon_date)
+            )
+        """
+        params = {
+            "warehouse_ids_list": warehouses.ids,
+            "horizon_dates": [horizon_dates[wh_id] for wh_id in warehouses.ids],
+            "warehouse_ids": tuple(warehouses.ids),
+        }
+        return cte, params
+
+    @api.model
+    def _get_promise_ledger_ctes(self, warehouses, where="TRUE", keep="FALSE"):
+        """Return the CTEs of the promise ledger and their params
+
+        The CTEs ``horizon``, ``promised`` and ``ordered`` read the moves of
+        the warehouses matching the SQL condition ``where`` (on the alias
+        ``move``), which are released or to release, within the horizon of
+        their warehouse or matching the SQL condition ``keep``. ``ordered``
+        gives for each of these moves (``id``) the quantity promised to the
+        other moves of its product and warehouse (``previous_qty``): a
+        running sum of the promise ledger (``promised_unreserved_qty``)
+        ordered by ``date_priority``.
+        """
+        horizon_cte, params = self._get_promise_horizon_cte(warehouses)
+        params["states"] = PROMISE_STATES
+        ctes = """
+            {horizon_cte},
+            promised AS (
+                SELECT move.id,
+                       move.product_id,
+                       move.warehouse_id,
+                       move.date_priority,
+                       move.need_release IS TRUE AS need_release,
+                       CASE WHEN horizon.horizon_date IS NULL
+                                 OR move.date_expected <= horizon.horizon_date
+                           THEN COALESCE(move.promised_unreserved_qty, 0)
+                           ELSE 0
+                       END AS qty
+                FROM stock_move move
+                JOIN horizon ON horizon.warehouse_id = move.warehouse_id
+                WHERE ({where})
+                AND move.warehouse_id IN %(warehouse_ids)s
+                AND (
+                    move.need_release IS TRUE
+                    OR move.state IN %(states)s
+                )
+                -- exclude moves planned beyond the horizon
+                AND (
+                    horizon.horizon_date IS NULL
+                    OR move.date_expected <= horizon.horizon_date
+                    OR ({keep})
+                )
+            ),
+            ordered AS (
+                SELECT id,
+                       -- released moves, whatever their priority
+                       COALESCE(
+                           SUM(qty) FILTER (WHERE NOT need_release)
+                           OVER by_product,
+                           0
+                       )
+                       -- moves to release with a strictly higher priority
+                       + CASE WHEN date_priority IS NULL THEN 0 ELSE
+                           COALESCE(
+                               SUM(qty) FILTER (WHERE need_release)
+                               OVER by_priority,
+                               0
+                           )
+                           - COALESCE(
+                               SUM(qty) FILTER (WHERE need_release)
+                               OVER same_priority,
+                               0
+                           )
+                       END AS previous_qty
+                FROM promised
+                WINDOW by_product AS (PARTITION BY product_id, warehouse_id),
+                       by_priority AS (
+                           PARTITION BY product_id, warehouse_id
+                           ORDER BY date_priority
+                       ),
+                       same_priority AS (
+                           PARTITION BY product_id, warehouse_id, date_priority
+                       )
+            )
+        """.format(
+            horizon_cte=horizon_cte.strip(), where=where, keep=keep
+        )
+        return ctes, params
 
     def release_available_to_promise(self):
         self._run_stock_rule()
 
+    def release_available_to_promise_in_background(self):
+        """Queue the moves to release them by chunks in background
+
+        Return the release runs, one per company, processed by a scheduled
+        action.
+        """
+        return self.env["stock.release.run"]._create_for_moves(self)
+
     def _prepare_move_split_vals(self, qty):
         vals = super()._prepare_move_split_vals(qty)
         # The method set procure_method as 'make_to_stock' by default on split,
@@ -144,76 +780,271 @@ class StockMove(models.Model):
         latest, we have to periodically retry to assign the remaining
         quantities.
         """
+        procurement_requests = []
+        pulled_moves = self.env["stock.move"]
+        profiler = ReleaseProfiler(self.env)
+        with profiler.phase("plan"):
+            self._release_lock_products(
+                self._release_with_all_at_once_moves().product_id
+            )
+            # Splitting the moves below does not change the quantities
+            # promised to the other moves, so we can plan them all beforehand.
+            release_plan = self._get_release_plan()
+        with profiler.phase("split"):
+            remaining_quantities = {
+                move: plan.remaining_qty
+                for move, plan in release_plan.items()
+                if plan.outcome == "partial"
+            }
+            new_moves = self.with_context(
+                release_available_to_promise=True
+            )._release_split_moves(remaining_quantities)
+            self.env["stock.picking"]._release_link_backorders(
+                {new_move.picking_id: move.picking_id for move, new_move in new_moves}
+            )
+        with profiler.phase("procurement"):
+            for move, plan in release_plan.items():
+                if plan.outcome not in ("full", "partial"):
+                    continue
+
+                values = move._prepare_procurement_values()
+                procurement_requests.append(
+                    self.env["procurement.group"].Procurement(
+                        move.product_id,
+                        move.product_uom_qty,
+                        move.product_uom,
+                        move.location_id,
+                        move.rule_id and move.rule_id.name or "/",
+                        move.origin,
+                        move.company_id,
+                        values,
+                    )
+                )
+                pulled_moves |= move
+
+            self.env["procurement.group"].run_defer(procurement_requests)
+
+        # Set all transfers released to "printed", consider the work has
+        # been planned and started and another "release" of moves should
+        # (for instance) merge new pickings with this "round of release".
+        with profiler.phase("set_printed"):
+            chain = self._release_get_chain(pulled_moves)
+            self._release_set_printed(pulled_moves, chain=chain)
+        with profiler.phase("assign"):
+            self._release_assign_moves(pulled_moves, chain=chain)
+        # the quantities promised by the released moves have changed
+        self._invalidate_ordered_available_to_promise()
+        profiler.done(len(self), len(pulled_moves), len(new_moves))
+
+        return True
+
+    def _get_release_plan(self):
+        """Compute what a release of the moves would do, without writing
+
+        Return a dict ``{move: ReleasePlan}`` for the moves which can be
+        released, and the other moves to release of their pickings shipped
+        all at once (see ``_release_with_all_at_once_moves``). The plan of all
+        the moves is computed at once, with the ordered available to promise
+        used by the release.
+        """
         precision = self.env["decimal.precision"].precision_get(
             "Product Unit of Measure"
         )
-        procurement_requests = []
-        pulled_moves = self.env["stock.move"]
-        backorder_links = {}
-        for move in self:
-            if not move.need_release:
-                continue
-            if move.state not in ("confirmed", "waiting"):
+        moves = self._release_with_all_at_once_moves()
+        all_at_once_moves = moves.filtered(
+            lambda move: move.picking_id.move_type == "one"
+        )
+        # the computed field is shared with the steps run before the release
+        # in the same transaction, it is computed at once for all the moves
+        available_quantities = {
+            move.id: move.ordered_available_to_promise for move in moves
+        }
+        short_pickings = all_at_once_moves.filtered(
+            lambda move: float_compare(
+                available_quantities[move.id],
+                move.product_qty,
+                precision_digits=precision,
+            )
+            < 0
+        ).picking_id
+
+        release_plan = {}
+        for move in moves:
+            available_quantity = available_quantities[move.id]
+            if move.picking_id in short_pickings:
+                # we don't want to deliver unless we can deliver all at once
+                release_plan[move] = self.ReleasePlan(
+                    available_quantity, 0.0, move.product_qty, "all_at_once"
+                )
                 continue
-            # do not use the computed field, because it will keep
-            # a value in cache that we cannot invalidate declaratively
-            available_quantity = move._ordered_available_to_promise()
             if float_compare(available_quantity, 0, precision_digits=precision) <= 0:
+                release_plan[move] = self.ReleasePlan(
+                    available_quantity, 0.0, move.product_qty, "nothing"
+                )
                 continue
 
             quantity = min(move.product_qty, available_quantity)
             remaining = move.product_qty - quantity
 
             if float_compare(remaining, 0, precision_digits=precision) > 0:
-                if move.picking_id.move_type == "one":
-                    # we don't want to deliver unless we can deliver all at
-                    # once
-                    continue
-                new_move = move.with_context(
-                    release_available_to_promise=True
-                )._release_split(remaining)
-                backorder_links[new_move.picking_id] = move.picking_id
-
-            values = move._prepare_procurement_values()
-            procurement_requests.append(
-                self.env["procurement.group"].Procurement(
-                    move.product_id,
-                    move.product_uom_qty,
-                    move.product_uom,
-                    move.location_id,
-                    move.rule_id and move.rule_id.name or "/",
-                    move.origin,
-                    move.company_id,
-                    values,
+                release_plan[move] = self.ReleasePlan(
+                    available_quantity, quantity, remaining, "partial"
+                )
+            else:
+                release_plan[move] = self.ReleasePlan(
+                    available_quantity, quantity, 0.0, "full"
                 )
+        return release_plan
+
+    @api.model
+    def _release_lock_products(self, products):
+        """Serialize the releases of the same products
+
+        Take a transaction-level advisory lock per product, in a stable order
+        to prevent deadlocks, so two transactions cannot promise the same
+        available quantities concurrently. A UserError is raised when a
+        product is being released by another transaction.
+
+        As the transaction runs in REPEATABLE READ, its snapshot may have been
+        taken before a concurrent release of the products was committed. The
+        products are then touched: PostgreSQL raises a serialization failure
+        if they have been released since the snapshot, and the transaction
+        is retried with a new snapshot instead of promising the quantities
+        again.
+        """
+        product_ids = sorted(set(products.ids))
+        if not product_ids:
+            return
+        self.env.cr.execute(
+            """
+            SELECT product_id
+            FROM (SELECT unnest(%s) AS product_id ORDER BY 1) product
+            WHERE NOT pg_try_advisory_xact_lock(%s, product_id)
+            """,
+            (product_ids, RELEASE_LOCK_KEY),
+        )
+        locked_ids = [row[0] for row in self.env.cr.fetchall()]
+        if locked_ids:
+            locked_products = self.env["product.product"].browse(locked_ids)
+            raise UserError(
+                _(
+                    "The following products are being released by another "
+                    "user, please retry in a moment:\n%s"
+                )
+                % "\n".join(locked_products.mapped("display_name"))
             )
-            pulled_moves |= move
+        self.env.cr.execute(
+            """
+            UPDATE product_product
+            SET last_release_date = now() at time zone 'UTC'
+            WHERE id IN %s
+            """,
+            (tuple(product_ids),),
+        )
+        products.invalidate_cache(fnames=["last_release_date"], ids=product_ids)
 
-        for backorder, origin in backorder_links.items():
-            backorder._release_link_backorder(origin)
+    @contextmanager
+    def _release_session_lock_products(self, products):
+        """Hold session-level locks on products to release them
 
-        self.env["procurement.group"].run_defer(procurement_requests)
+        The locks are waited for, then the transaction is committed: the
+        snapshot of the next transaction, in which the block releases the
+        products, is taken once the concurrent releases are committed. The
+        locks are held until the end of the block, which must commit its
+        work; it is rolled back if the block raises.
+        """
+        product_ids = sorted(set(products.ids))
+        if not product_ids:
+            yield
+            return
+        cr = self.env.cr
+        cr.execute(
+            """
+            SELECT pg_advisory_lock(%s, product_id)
+            FROM (SELECT unnest(%s) AS product_id ORDER BY 1) product
+            """,
+            (RELEASE_LOCK_KEY, product_ids),
+        )
+        cr.commit()  # pylint: disable=invalid-commit
+        self.invalidate_cache()
+        try:
+            yield
+        except Exception:
+            cr.rollback()
+            raise
+        finally:
+            cr.execute(
+                """
+                SELECT pg_advisory_unlock(%s, product_id)
+                FROM unnest(%s) AS product_id
+                """,
+                (RELEASE_LOCK_KEY, product_ids),
+            )
 
-        # Set all transfers released to "printed", consider the work has
-        # been planned and started and another "release" of moves should
-        # (for instance) merge new pickings with this "round of release".
-        self._release_set_printed(pulled_moves)
-        self._release_assign_moves(pulled_moves)
+    def _is_release_needed(self):
+        return self.need_release and self.state in ("confirmed", "waiting")
 
-        return True
+    def _release_with_all_at_once_moves(self):
+        """Return the moves to release, with their siblings shipped at once
 
-    def _release_set_printed(self, moves):
-        picking_ids = set()
-        while moves:
-            picking_ids.update(moves.mapped("picking_id").ids)
-            moves = moves.mapped("move_orig_ids")
-        pickings = self.env["stock.picking"].browse(picking_ids)
-        pickings.filtered(lambda p: not p.printed).printed = True
+        The moves of a picking shipped all at once are released together or
+        not at all: releasing one of them releases all the moves to release
+        of its picking, even the ones which are not part of the selection.
+        """
+        moves = self.filtered(lambda move: move._is_release_needed())
+        return moves | moves.picking_id.filtered(
+            lambda picking: picking.move_type == "one"
+        ).move_lines.filtered(lambda move: move._is_release_needed())
 
-    def _release_assign_moves(self, moves):
-        while moves:
-            moves._action_assign()
-            moves = moves.mapped("move_orig_ids")
+    @api.model
+    def _release_get_chain(self, moves):
+        """Return the moves and all their origin moves, level by level
+
+        The chains are resolved with a single recursive query. The result is
+        a list of recordsets, the first one being ``moves``, then their origin
+        moves, the origins of these ones, ... A move which is reached by
+        several paths is only in its deepest level.
+        """
+        if not moves:
+            return []
+        self.flush(["move_orig_ids"])
+        self.env.cr.execute(
+            """
+            WITH RECURSIVE chain (move_id, depth, path) AS (
+                SELECT id, 0, ARRAY[id]
+                FROM stock_move
+                WHERE id IN %s
+                UNION ALL
+                SELECT rel.move_orig_id, chain.depth + 1,
+                       chain.path || rel.move_orig_id
+                FROM chain
+                JOIN stock_move_move_rel rel
+                ON rel.move_dest_id = chain.move_id
+                -- guard against cycles in the chain
+                WHERE NOT rel.move_orig_id = ANY(chain.path)
+            )
+            SELECT move_id, MAX(depth)
+            FROM chain
+            GROUP BY move_id
+            """,
+            (tuple(moves.ids),),
+        )
+        level_ids = defaultdict(list)
+        for move_id, depth in self.env.cr.fetchall():
+            level_ids[depth].append(move_id)
+        return [self.browse(level_ids[depth]) for depth in sorted(level_ids)]
+
+    def _release_set_printed(self, moves, chain=None):
+        if chain is None:
+            chain = self._release_get_chain(moves)
+        all_moves = self.browse().union(*chain)
+        all_moves.picking_id.filtered(lambda p: not p.printed).write({"printed": True})
+
+    def _release_assign_moves(self, moves, chain=None):
+        if chain is None:
+            chain = self._release_get_chain(moves)
+        for level_moves in chain:
+            level_moves._action_assign()
 
     def _release_split(self, remaining_qty):
         """Split move and create a new picking for it.
@@ -222,14 +1053,75 @@ class StockMove(models.Model):
         we move it to a new one so that we can release it later as soon as
         the qty is available.
         """
+        new_moves = self._release_split_moves({self: remaining_qty})
+        return new_moves[0][1] if new_moves else self
+
+    @api.model
+    def _release_split_moves(self, remaining_quantities):
+        """Split many moves and put the new moves in new pickings
+
+        Bulk version of ``_release_split``: ``remaining_quantities`` is a dict
+        ``{move: quantity to split}``, with quantities in the UoM of the
+        product as for ``_split``. The new moves are created at once and
+        assigned to new pickings at once. Return a list of tuples
+        ``(move, new move)``.
+        """
+        precision = self.env["decimal.precision"].precision_get(
+            "Product Unit of Measure"
+        )
+        to_split = [
+            (move.with_env(self.env), qty)
+            for move, qty in remaining_quantities.items()
+            if float_compare(qty, 0, precision_digits=precision) > 0
+            and float_compare(move.product_qty, qty, precision_digits=precision) > 0
+        ]
+        if not to_split:
+            return []
         # Rely on `printed` flag to make _assign_picking create a new picking.
         # See `stock.move._assign_picking` and
         # `stock.move._search_picking_for_assignation`.
-        if not self.picking_id.printed:
-            self.picking_id.printed = True
-        new_move = self.browse(self._split(remaining_qty))
-        # Picking assignment is needed here because `_split` copies the move
+        origin_moves = self.browse().union(*[move for move, __ in to_split])
+        origin_moves.picking_id.filtered(lambda p: not p.printed).write(
+            {"printed": True}
+        )
+        vals_list = []
+        new_quantities = defaultdict(lambda: self.browse())
+        for move, qty in to_split:
+            vals_list += move.copy_data(move._release_split_defaults(qty))
+            new_product_qty = float_round(
+                move.product_id.uom_id._compute_quantity(
+                    move.product_qty - qty, move.product_uom, round=False
+                ),
+                precision_digits=precision,
+            )
+            new_quantities[new_product_qty] |= move
+        new_moves = self.with_context(rounding_method="HALF-UP").create(vals_list)
+        for new_product_qty, moves in new_quantities.items():
+            moves.with_context(do_not_unreserve=True, rounding_method="HALF-UP").write(
+                {"product_uom_qty": new_product_qty}
+            )
+        split_moves = list(zip([move for move, __ in to_split], new_moves))
+        new_moves = new_moves._action_confirm(merge=False)
+        # Picking assignment is needed here because the new moves are copies
         # thus the `_should_be_assigned` condition is not satisfied
-        # and the move is not assigned.
-        new_move._assign_picking()
-        return new_move
+        # and the moves are not assigned.
+        new_moves._assign_picking()
+        return split_moves
+
+    def _release_split_defaults(self, qty):
+        """Values of the move split from this one, as in ``_split``"""
+        self.ensure_one()
+        uom_qty = self.product_id.uom_id._compute_quantity(
+            qty, self.product_uom, rounding_method="HALF-UP"
+        )
+        back_qty = self.product_uom._compute_quantity(
+            uom_qty, self.product_id.uom_id, rounding_method="HALF-UP"
+        )
+        precision = self.env["decimal.precision"].precision_get(
+            "Product Unit of Measure"
+        )
+        if float_compare(qty, back_qty, precision_digits=precision) == 0:
+            return self._prepare_move_split_vals(uom_qty)
+        return self.with_context(
+            force_split_uom_id=self.product_id.uom_id.id
+        )._prepare_move_split_vals(qty)
@@ -1,19 +1,214 @@
 # Copyright 2019 Camptocamp (https://www.camptocamp.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+import operator
+from collections import defaultdict
+
 from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+from odoo.tools.sql import column_exists, create_column
+
+from .stock_move import PROMISE_STATES
+
+SEARCH_OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+NEGATED_SEARCH_OPERATORS = {
+    "=": "!=",
+    "!=": "=",
+    "<": ">=",
+    "<=": ">",
+    ">": "<=",
+    ">=": "<",
+}
 
 
 class StockPicking(models.Model):
     _inherit = "stock.picking"
 
-    need_release = fields.Boolean(compute="_compute_need_release")
+    need_release = fields.Boolean(
+        compute="_compute_need_release", store=True, index=True
+    )
+    release_ratio = fields.Float(
+        string="Releasable Quantity Ratio",
+        compute="_compute_release_ratio",
+        search="_search_release_ratio",
+        digits=(16, 2),
+        help="Percentage of the quantity to release available to promise.",
+    )
+
+    def _auto_init(self):
+        # Create the column beforehand so the ORM does not compute the field
+        # on every picking when the module is installed, one query is enough.
+        if not column_exists(self.env.cr, "stock_picking", "need_release"):
+            create_column(self.env.cr, "stock_picking", "need_release", "boolean")
+            self.env.cr.execute(
+                """
+                UPDATE stock_picking
+                SET need_release = EXISTS (
+                    SELECT 1 FROM stock_move
+                    WHERE stock_move.picking_id = stock_picking.id
+                    AND stock_move.need_release IS TRUE
+                )
+                """
+            )
+        return super()._auto_init()
 
     @api.depends("move_lines.need_release")
     def _compute_need_release(self):
         for picking in self:
             picking.need_release = any(move.need_release for move in picking.move_lines)
 
+    @api.depends()
+    def _compute_release_ratio(self):
+        ratios = self._get_release_ratio()
+        for picking in self:
+            picking.release_ratio = ratios.get(picking.id, 0.0)
+
+    def _get_release_ratio(self):
+        """Ratio of the quantity to release available to promise, in percent
+
+        Computed for all the pickings at once. Return ``{picking id: ratio}``
+        for the pickings which need a release.
+        """
+        pickings = self.filtered("need_release")
+        moves = pickings.move_lines.filtered("need_release")
+        available_quantities = moves._get_ordered_available_to_promise()
+        totals = {}
+        for move in moves:
+            if move.id in available_quantities:
+                available_quantity = available_quantities[move.id]
+            else:
+                available_quantity = move._ordered_available_to_promise()
+            total, available = totals.get(move.picking_id.id, (0.0, 0.0))
+            totals[move.picking_id.id] = (
+                total + move.product_qty,
+                available + min(max(available_quantity, 0.0), move.product_qty),
+            )
+        return {
+            picking_id: 100.0 * available / total if total else 0.0
+            for picking_id, (total, available) in totals.items()
+        }
+
+    def _search_release_ratio(self, operator, value):
+        if operator not in SEARCH_OPERATORS:
+            raise UserError(
+                _("Operator %s is not supported on the releasable ratio.") % operator
+            )
+        value = value or 0.0
+        self.env["base"].flush()
+        if SEARCH_OPERATORS[operator](0.0, value):
+            # the ratio of the pickings which do not need a release is 0, they
+            # match: exclude the pickings to release which do not match
+            query, params = self._get_release_ratio_search_query(
+                NEGATED_SEARCH_OPERATORS[operator], value
+            )
+            self.env.cr.execute(query, params)  # pylint: disable=sql-injection
+            return [("id", "not in", [row[0] for row in self.env.cr.fetchall()])]
+        query, params = self._get_release_ratio_search_query(operator, value)
+        self.env.cr.execute(query, params)  # pylint: disable=sql-injection
+        return [("id", "in", [row[0] for row in self.env.cr.fetchall()])]
+
+    @api.model
+    def _get_release_ratio_search_query(self, operator, value):
+        """Return the query and params of the search on the release ratio
+
+        The ratio of all the pickings which need a release is computed in a
+        single query: the stock of the warehouses is summed from the quants
+        and the quantity promised to the moves with a higher priority is read
+        from the promise ledger (``stock.move._get_promise_ledger_ctes``),
+        for the products to release only. The query returns the ids of the
+        pickings to release whose ratio matches ``operator`` and ``value``.
+        """
+        warehouses = (
+            self.env["stock.warehouse"].with_context(active_test=False).search([])
+        )
+        ledger_ctes, params = self.env["stock.move"]._get_promise_ledger_ctes(
+            warehouses,
+            where="move.product_id IN (SELECT product_id FROM to_release)",
+            keep="move.need_release IS TRUE",
+        )
+        query = """
+            WITH to_release AS (
+                SELECT DISTINCT move.product_id, move.warehouse_id
+                FROM stock_move move
+                WHERE move.need_release IS TRUE
+            ),
+            {ledger_ctes},
+            on_hand AS (
+                SELECT quant.product_id,
+                       warehouse.id AS warehouse_id,
+                       SUM(quant.quantity) AS qty
+                FROM stock_warehouse warehouse
+                JOIN stock_location location
+                ON location.id = warehouse.lot_stock_id
+                JOIN stock_location child
+                ON child.parent_path LIKE location.parent_path || '%%'
+                JOIN stock_quant quant
+                ON quant.location_id = child.id
+                JOIN to_release
+                ON to_release.product_id = quant.product_id
+                AND to_release.warehouse_id = warehouse.id
+                GROUP BY quant.product_id, warehouse.id
+            ),
+            available AS (
+                SELECT move.picking_id,
+                       move.product_qty,
+                       CASE WHEN picking_type.code = 'outgoing'
+                                 AND template.type != 'consu'
+                                 AND location.usage NOT IN %(bypass_usages)s
+                                 AND location.scrap_location IS NOT TRUE
+                           THEN GREATEST(
+                               LEAST(
+                                   COALESCE(on_hand.qty, 0)
+                                   - COALESCE(ordered.previous_qty, 0),
+                                   move.product_qty
+                               ),
+                               0
+                           )
+                           ELSE 0
+                       END AS qty
+                FROM stock_move move
+                JOIN stock_picking picking
+                ON picking.id = move.picking_id
+                JOIN product_product product
+                ON product.id = move.product_id
+                JOIN product_template template
+                ON template.id = product.product_tmpl_id
+                JOIN stock_location location
+                ON location.id = move.location_id
+                LEFT JOIN stock_picking_type picking_type
+                ON picking_type.id = move.picking_type_id
+                LEFT JOIN ordered
+                ON ordered.id = move.id
+                LEFT JOIN on_hand
+                ON on_hand.product_id = move.product_id
+                AND on_hand.warehouse_id = move.warehouse_id
+                WHERE move.need_release IS TRUE
+                AND picking.need_release IS TRUE
+            )
+            SELECT picking_id
+            FROM available
+            GROUP BY picking_id
+            HAVING CASE WHEN SUM(product_qty) = 0 THEN 0
+                       ELSE 100.0 * SUM(qty) / SUM(product_qty)
+                   END {operator} %(value)s
+        """.format(
+            ledger_ctes=ledger_ctes.strip(), operator=operator
+        )
+        params.update(
+            {
+                "bypass_usages": ("supplier", "customer", "inventory", "production"),
+                "value": value or 0.0,
+            }
+        )
+        return query, params
+
     def release_available_to_promise(self):
         # When the stock.picking form view is opened through the "Deliveries"
         # button of a sale order, the latter sets values in the context such as
@@ -26,12 +221,49 @@ class StockPicking(models.Model):
         }
         self.mapped("move_lines").with_context(context).release_available_to_promise()
 
+    def _get_release_plan(self):
+        """Compute what a release of the pickings would do, without writing
+
+        Return a dict ``{picking: {"moves": {move: ReleasePlan},
+        "backorder": bool}}``, "backorder" being set when a backorder would
+        be created for the quantities not released.
+        """
+        move_plans = self.mapped("move_lines")._get_release_plan()
+        result = {}
+        for move, plan in move_plans.items():
+            picking_plan = result.setdefault(
+                move.picking_id, {"moves": {}, "backorder": False}
+            )
+            picking_plan["moves"][move] = plan
+            if plan.outcome == "partial":
+                picking_plan["backorder"] = True
+        return result
+
+    def release_available_to_promise_in_background(self):
+        return self.mapped("move_lines").release_available_to_promise_in_background()
+
     def _release_link_backorder(self, origin_picking):
-        self.backorder_id = origin_picking
-        origin_picking.message_post(
-            body=_(
-                "The backorder <a href=# data-oe-model=stock.picking"
-                " data-oe-id=%d>%s</a> has been created."
+        self._release_link_backorders({self: origin_picking})
+
+    @api.model
+    def _release_link_backorders(self, backorder_links):
+        """Link backorders to their origin picking
+
+        ``backorder_links`` is a dict ``{backorder: origin picking}``. One
+        message is posted on each origin picking for all its backorders.
+        """
+        backorders_by_origin = defaultdict(lambda: self.browse())
+        for backorder, origin_picking in backorder_links.items():
+            backorders_by_origin[origin_picking] |= backorder
+        for origin_picking, backorders in backorders_by_origin.items():
+            backorders.write({"backorder_id": origin_picking.id})
+            links = ", ".join(
+                "<a href=# data-oe-model=stock.picking data-oe-id=%d>%s</a>"
+                % (backorder.id, backorder.name)
+                for backorder in backorders
             )
-            % (self.id, self.name)
-        )
+            if len(backorders) == 1:
+                body = _("The backorder %s has been created.") % links
+            else:
+                body = _("The backorders %s have been created.") % links
+            origin_picking.message_post(body=body)
@@ -0,0 +1,32 @@
+# Copyright 2020 Camptocamp (https://www.camptocamp.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import fields, models
+
+
+class StockPickingType(models.Model):
+    _inherit = "stock.picking.type"
+
+    release_wave_line_capacity = fields.Integer(
+        string="Lines per Release Wave",
+        help="Maximum number of moves of this operation type released and "
+        "not ready to ship yet. When set, the scheduled release waves release "
+        "moves up to this capacity, by priority.",
+    )
+    release_wave_weight_capacity = fields.Float(
+        string="Weight per Release Wave",
+        digits="Stock Weight",
+        help="Maximum weight (kg) of the moves of this operation type released "
+        "and not ready to ship yet. When set, the scheduled release waves "
+        "release moves up to this capacity, by priority.",
+    )
+
+    def action_release_wave(self):
+        self.ensure_one()
+        wave = self.env["stock.release.wave"]._release_wave(self)
+        return {
+            "type": "ir.actions.act_window",
+            "res_model": "stock.release.wave",
+            "res_id": wave.id,
+            "view_mode": "form",
+        }
@@ -0,0 +1,24 @@
+# Copyright 2020 Camptocamp (https://www.camptocamp.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, models
+
+
+class StockQuant(models.Model):
+    _inherit = "stock.quant"
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env["product.product"]._invalidate_promisable_cache()
+        self.env["stock.move"]._invalidate_ordered_available_to_promise()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        self.env["product.product"]._invalidate_promisable_cache()
+        self.env["stock.move"]._invalidate_ordered_available_to_promise()
+        return super().write(vals)
+
+    def unlink(self):
+        self.env["product.product"]._invalidate_promisable_cache()
+        self.env["stock.move"]._invalidate_ordered_available_to_promise()
+        return super().unlink()
@@ -0,0 +1,366 @@
+# Copyright 2020 Camptocamp (https://www.camptocamp.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from odoo import _, api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+
+class StockReleaseRun(models.Model):
+    _name = "stock.release.run"
+    _description = "Stock Release Run"
+    _order = "id desc"
+
+    name = fields.Char(required=True, readonly=True, copy=False, default="/")
+    state = fields.Selection(
+        [("queued", "Queued"), ("running", "Running"), ("done", "Done")],
+        required=True,
+        default="queued",
+        readonly=True,
+        index=True,
+    )
+    trigger = fields.Selection(
+        [("manual", "Manual"), ("stock_arrival", "Stock Arrival")],
+        required=True,
+        default="manual",
+        readonly=True,
+        help="Stock Arrival: the moves have been queued automatically when "
+        "their products have been received.",
+    )
+    company_id = fields.Many2one(
+        "res.company", required=True, default=lambda self: self.env.company
+    )
+    user_id = fields.Many2one(
+        "res.users",
+        string="Responsible",
+        required=True,
+        default=lambda self: self.env.user,
+    )
+    chunk_size = fields.Integer(
+        required=True,
+        default=lambda self: self.env.company.stock_release_chunk_size,
+        help="Number of moves released in a transaction.",
+    )
+    parallel_workers = fields.Integer(
+        required=True,
+        default=1,
+        help="Number of workers releasing the moves in parallel when the run "
+        "is processed by the scheduled action. Each worker releases the moves "
+        "of distinct products.",
+    )
+    date_start = fields.Datetime(readonly=True)
+    date_end = fields.Datetime(readonly=True)
+    queue_ids = fields.One2many(
+        "stock.release.queue", "run_id", string="Queue", readonly=True
+    )
+    move_count = fields.Integer(compute="_compute_progress")
+    processed_count = fields.Integer(compute="_compute_progress")
+    failed_count = fields.Integer(compute="_compute_progress")
+    progress = fields.Float(compute="_compute_progress")
+
+    @api.depends("queue_ids.state")
+    def _compute_progress(self):
+        data = self.env["stock.release.queue"].read_group(
+            [("run_id", "in", self.ids)],
+            ["run_id", "state"],
+            ["run_id", "state"],
+            lazy=False,
+        )
+        counts = {(row["run_id"][0], row["state"]): row["__count"] for row in data}
+        for run in self:
+            pending = counts.get((run.id, "pending"), 0)
+            done = counts.get((run.id, "done"), 0)
+            failed = counts.get((run.id, "failed"), 0)
+            run.move_count = pending + done + failed
+            run.processed_count = done + failed
+            run.failed_count = failed
+            run.progress = (
+                100.0 * run.processed_count / run.move_count if run.move_count else 0.0
+            )
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        for vals in vals_list:
+            if vals.get("name", "/") == "/":
+                vals["name"] = self.env["ir.sequence"].next_by_code("stock.release.run")
+        return super().create(vals_list)
+
+    @api.model
+    def _create_for_moves(self, moves):
+        """Create the runs which will release the moves in background
+
+        One run is created per company of the moves, as the moves are
+        released in the context of the company of their run.
+        """
+        moves = moves.filtered("need_release")
+        vals_list = []
+        for company in moves.company_id:
+            company_moves = moves.filtered(lambda move: move.company_id == company)
+            vals_list.append(
+                {
+                    "company_id": company.id,
+                    "chunk_size": company.stock_release_chunk_size,
+                    "queue_ids": [
+                        (0, 0, {"move_id": move.id}) for move in company_moves
+                    ],
+                }
+            )
+        return self.create(vals_list)
+
+    def action_view_runs(self):
+        """Open the runs, in a form view when there is only one"""
+        action = {
+            "type": "ir.actions.act_window",
+            "name": _("Release Runs"),
+            "res_model": self._name,
+        }
+        if len(self) == 1:
+            action.update({"res_id": self.id, "view_mode": "form"})
+        else:
+            action.update(
+                {"domain": [("id", "in", self.ids)], "view_mode": "tree,form"}
+            )
+        return action
+
+    @api.model
+    def _enqueue_on_stock_arrival(self, moves):
+        """Queue moves in the stock arrival run of their company
+
+        The moves already waiting in a queue are ignored. The run is created
+        if no stock arrival run is waiting to be processed.
+        """
+        queued_moves = (
+            self.env["stock.release.queue"]
+            .search([("move_id", "in", moves.ids), ("state", "=", "pending")])
+            .move_id
+        )
+        moves = moves.filtered("need_release") - queued_moves
+        for company in moves.company_id:
+            company_moves = moves.filtered(lambda move: move.company_id == company)
+            run = self.search(
+                [
+                    ("trigger", "=", "stock_arrival"),
+                    ("state", "=", "queued"),
+                    ("company_id", "=", company.id),
+                ],
+                limit=1,
+            )
+            if not run:
+                run = self.create(
+                    {"trigger": "stock_arrival", "company_id": company.id}
+                )
+            run.write(
+                {"queue_ids": [(0, 0, {"move_id": move.id}) for move in company_moves]}
+            )
+
+    def action_process(self):
+        """Release the queued moves now, in the current transaction"""
+        self._process()
+
+    def action_retry_failed(self):
+        self.queue_ids.filtered(lambda item: item.state == "failed").write(
+            {"state": "pending", "error": False}
+        )
+        self.filtered(lambda run: run.state == "done").write({"state": "queued"})
+
+    @api.model
+    def _cron_process_release_queue(self):
+        runs = self.search([("state", "in", ("queued", "running"))], order="id")
+        runs._process(auto_commit=True)
+
+    def _process(self, auto_commit=False):
+        """Release the moves of the queue, chunk by chunk
+
+        When ``auto_commit`` is set, the transaction is committed after each
+        chunk, so the progress is visible and the locks are released while
+        the run goes on.
+        """
+        for run in self:
+            run = run.with_context(allowed_company_ids=run.company_id.ids)
+            if run.state == "queued":
+                run.write({"state": "running", "date_start": fields.Datetime.now()})
+            if auto_commit and run.parallel_workers > 1:
+                run._process_parallel()
+            # process what is left by the parallel workers if any
+            run._process_chunks(auto_commit=auto_commit)
+            run.write({"state": "done", "date_end": fields.Datetime.now()})
+            if auto_commit:
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    def _process_chunks(self, product_ids=None, auto_commit=False):
+        self.ensure_one()
+        while True:
+            items = self._next_chunk(product_ids=product_ids)
+            if not items:
+                break
+            if not auto_commit:
+                self._release_chunk(items)
+                continue
+            # If another release of these products is running, we wait until
+            # it is committed and the chunk is released in a new transaction,
+            # so the available to promise is computed from a snapshot
+            # including its reservations.
+            with self.env["stock.move"]._release_session_lock_products(
+                items.move_id._release_with_all_at_once_moves().product_id
+            ):
+                self._release_chunk(items)
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    def _process_parallel(self):
+        """Release the queue with parallel workers
+
+        The products of the pending moves are partitioned (see
+        ``_product_partitions``) and each partition is released by a thread
+        with its own cursor. The workers neither release the same products
+        nor write the same transfers, so they do not wait for each other.
+        """
+        self.ensure_one()
+        partitions = self._product_partitions(self.parallel_workers)
+        # the workers must see the state of the run
+        self.env.cr.commit()  # pylint: disable=invalid-commit
+        threads = [
+            threading.Thread(
+                target=self._process_partition_in_new_cursor,
+                args=(product_ids,),
+                name="{}-{}".format(self.name, index),
+            )
+            for index, product_ids in enumerate(partitions)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.invalidate_cache()
+
+    def _process_partition_in_new_cursor(self, product_ids):
+        with api.Environment.manage(), self.pool.cursor() as cr:
+            run = self.with_env(self.env(cr=cr))
+            try:
+                run._process_chunks(product_ids=product_ids, auto_commit=True)
+            except Exception:  # pylint: disable=broad-except
+                # the pending moves are processed by the main worker
+                _logger.exception("release worker of %s failed", run.name)
+                cr.rollback()
+
+    def _product_partitions(self, count):
+        """Partition the products of the pending moves
+
+        The products and the procurement groups of the pending moves are
+        linked in a graph: the products of a connected component are
+        released by the same worker, so two workers never share a product
+        nor a procurement group. Return at most ``count`` lists of product
+        ids, the components being balanced on their number of pending moves.
+        """
+        self.ensure_one()
+        data = self.env["stock.release.queue"].read_group(
+            [("run_id", "=", self.id), ("state", "=", "pending")],
+            ["product_id", "group_id"],
+            ["product_id", "group_id"],
+            lazy=False,
+        )
+        # union-find on the products and the groups
+        parents = {}
+
+        def find(node):
+            parents.setdefault(node, node)
+            while parents[node] != node:
+                parents[node] = parents[parents[node]]
+                node = parents[node]
+            return node
+
+        for row in data:
+            product_root = find(("product", row["product_id"][0]))
+            if row["group_id"]:
+                group_root = find(("group", row["group_id"][0]))
+                parents[group_root] = product_root
+        components = defaultdict(lambda: {"product_ids": set(), "size": 0})
+        for row in data:
+            product_id = row["product_id"][0]
+            component = components[find(("product", product_id))]
+            component["product_ids"].add(product_id)
+            component["size"] += row["__count"]
+        partitions = [[] for __ in range(max(count, 1))]
+        sizes = [0] * len(partitions)
+        for component in sorted(
+            components.values(), key=lambda component: component["size"], reverse=True
+        ):
+            index = sizes.index(min(sizes))
+            partitions[index] += sorted(component["product_ids"])
+            sizes[index] += component["size"]
+        return [partition for partition in partitions if partition]
+
+    def _next_chunk(self, product_ids=None):
+        self.ensure_one()
+        domain = [("run_id", "=", self.id), ("state", "=", "pending")]
+        if product_ids is not None:
+            domain.append(("product_id", "in", product_ids))
+        return self.env["stock.release.queue"].search(
+            domain, limit=max(self.chunk_size, 1)
+        )
+
+    def _release_chunk(self, items):
+        """Release the moves of a chunk of the queue
+
+        If the release of the chunk fails, its moves are released one by one
+        to isolate the failing ones.
+        """
+        try:
+            with self._savepoint():
+                items.move_id.release_available_to_promise()
+        except Exception:  # pylint: disable=broad-except
+            for item in items:
+                item._release_isolated()
+        else:
+            items.write({"state": "done"})
+
+    @contextmanager
+    def _savepoint(self):
+        self.env["base"].flush()
+        with self.env.cr.savepoint():
+            try:
+                yield
+                self.env["base"].flush()
+            except Exception:
+                # drop the cache and the pending writes done in the savepoint
+                self.env.clear()
+                raise
+
+
+class StockReleaseQueue(models.Model):
+    _name = "stock.release.queue"
+    _description = "Stock Release Queue"
+    _order = "date_priority, id"
+
+    run_id = fields.Many2one(
+        "stock.release.run", required=True, ondelete="cascade", index=True
+    )
+    move_id = fields.Many2one(
+        "stock.move", required=True, ondelete="cascade", index=True
+    )
+    picking_id = fields.Many2one(related="move_id.picking_id")
+    product_id = fields.Many2one(related="move_id.product_id", store=True, index=True)
+    group_id = fields.Many2one(related="move_id.group_id", store=True, index=True)
+    date_priority = fields.Datetime(related="move_id.date_priority", store=True)
+    state = fields.Selection(
+        [("pending", "Pending"), ("done", "Done"), ("failed", "Failed")],
+        required=True,
+        default="pending",
+        index=True,
+    )
+    error = fields.Text(readonly=True)
+
+    def _release_isolated(self):
+        self.ensure_one()
+        run = self.run_id
+        try:
+            with run._savepoint():
+                self.move_id.release_available_to_promise()
+        except Exception as err:  # pylint: disable=broad-except
+            _logger.exception("release of stock move %d failed", self.move_id.id)
+            self.write({"state": "failed", "error": str(err)})
+        else:
+            self.write({"state": "done"})
@@ -0,0 +1,111 @@
+# Copyright 2020 Camptocamp (https://www.camptocamp.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+import logging
+import time
+from contextlib import contextmanager
+
+from odoo import fields, models
+
+_logger = logging.getLogger(__name__)
+
+RELEASE_PHASES = ("plan", "split", "procurement", "set_printed", "assign")
+
+
+class ReleaseProfiler(object):
+    """Measure the duration and number of queries of the phases of a release
+
+    The pending writes are flushed at the end of each phase, so their queries
+    are counted in the phase which did them.
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        query_count = self.env.cr.sql_log_count
+        start = time.perf_counter()
+        yield
+        self.env["base"].flush()
+        duration, count = self.phases.get(name, (0.0, 0))
+        self.phases[name] = (
+            duration + time.perf_counter() - start,
+            count + self.env.cr.sql_log_count - query_count,
+        )
+
+    def done(self, move_count, released_move_count, split_move_count):
+        """Log the statistics and store them if the company records them"""
+        duration = sum(duration for duration, __ in self.phases.values())
+        query_count = sum(count for __, count in self.phases.values())
+        _logger.info(
+            "release statistics: moves=%d released=%d split=%d "
+            "duration=%.3f queries=%d %s",
+            move_count,
+            released_move_count,
+            split_move_count,
+            duration,
+            query_count,
+            " ".join(
+                "{name}_duration={duration:.3f} {name}_queries={count}".format(
+                    name=name, duration=phase_duration, count=phase_count
+                )
+                for name, (phase_duration, phase_count) in self.phases.items()
+            ),
+        )
+        if not self.env.company.stock_release_statistics:
+            return
+        vals = {
+            "move_count": move_count,
+            "released_move_count": released_move_count,
+            "split_move_count": split_move_count,
+            "duration": duration,
+            "query_count": query_count,
+        }
+        for name, (phase_duration, phase_count) in self.phases.items():
+            vals["{}_duration".format(name)] = phase_duration
+            vals["{}_query_count".format(name)] = phase_count
+        self.env["stock.release.statistics"].sudo().create(vals)
+
+
+class StockReleaseStatistics(models.Model):
+    _name = "stock.release.statistics"
+    _description = "Stock Release Statistics"
+    _order = "date desc, id desc"
+
+    date = fields.Datetime(required=True, readonly=True, default=fields.Datetime.now)
+    user_id = fields.Many2one(
+        "res.users", readonly=True, default=lambda self: self.env.user
+    )
+    company_id = fields.Many2one(
+        "res.company", readonly=True, default=lambda self: self.env.company
+    )
+    move_count = fields.Integer(string="Moves", readonly=True)
+    released_move_count = fields.Integer(string="Released Moves", readonly=True)
+    split_move_count = fields.Integer(string="Split Moves", readonly=True)
+    duration = fields.Float(string="Duration (s)", readonly=True, digits=(16, 3))
+    query_count = fields.Integer(string="Queries", readonly=True)
+    plan_duration = fields.Float(
+        string="Available to Promise (s)", readonly=True, digits=(16, 3)
+    )
+    plan_query_count = fields.Integer(
+        string="Available to Promise Queries", readonly=True
+    )
+    split_duration = fields.Float(string="Split (s)", readonly=True, digits=(16, 3))
+    split_query_count = fields.Integer(string="Split Queries", readonly=True)
+    procurement_duration = fields.Float(
+        string="Procurement (s)", readonly=True, digits=(16, 3)
+    )
+    procurement_query_count = fields.Integer(
+        string="Procurement Queries", readonly=True
+    )
+    set_printed_duration = fields.Float(
+        string="Set Printed (s)", readonly=True, digits=(16, 3)
+    )
+    set_printed_query_count = fields.Integer(
+        string="Set Printed Queries", readonly=True
+    )
+    assign_duration = fields.Float(
+        string="Assignation (s)", readonly=True, digits=(16, 3)
+    )
+    assign_query_count = fields.Integer(string="Assignation Queries", readonly=True)
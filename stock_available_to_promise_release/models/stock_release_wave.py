@@ -0,0 +1,258 @@
+# Copyright 2020 Camptocamp (https://www.camptocamp.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+import logging
+from collections import defaultdict
+
+from odoo import api, fields, models
+from odoo.tools import float_compare
+
+_logger = logging.getLogger(__name__)
+
+# states of the released moves which are still being prepared
+IN_PROGRESS_STATES = ("waiting", "confirmed", "partially_available")
+
+
+class StockReleaseWave(models.Model):
+    _name = "stock.release.wave"
+    _description = "Stock Release Wave"
+    _order = "id desc"
+
+    name = fields.Char(required=True, readonly=True, copy=False, default="/")
+    picking_type_id = fields.Many2one(
+        "stock.picking.type",
+        string="Operation Type",
+        required=True,
+        readonly=True,
+        ondelete="cascade",
+        index=True,
+    )
+    company_id = fields.Many2one(
+        related="picking_type_id.company_id", store=True, readonly=True
+    )
+    date = fields.Datetime(required=True, readonly=True, default=fields.Datetime.now)
+    line_capacity = fields.Integer(readonly=True)
+    weight_capacity = fields.Float(readonly=True, digits="Stock Weight")
+    in_progress_line_count = fields.Integer(
+        string="Lines in Progress",
+        readonly=True,
+        help="Moves released and not ready to ship yet when this wave has "
+        "been released.",
+    )
+    in_progress_weight = fields.Float(
+        string="Weight in Progress", readonly=True, digits="Stock Weight"
+    )
+    released_line_count = fields.Integer(string="Lines Released", readonly=True)
+    released_weight = fields.Float(
+        string="Weight Released", readonly=True, digits="Stock Weight"
+    )
+    capacity_usage = fields.Float(
+        compute="_compute_capacity_usage",
+        help="Percentage of the capacity used by the lines in progress and "
+        "released by this wave.",
+    )
+    move_ids = fields.One2many(
+        "stock.move", "release_wave_id", string="Released Moves", readonly=True
+    )
+
+    @api.depends(
+        "line_capacity",
+        "weight_capacity",
+        "in_progress_line_count",
+        "in_progress_weight",
+        "released_line_count",
+        "released_weight",
+    )
+    def _compute_capacity_usage(self):
+        for wave in self:
+            usages = []
+            if wave.line_capacity:
+                usages.append(
+                    (wave.in_progress_line_count + wave.released_line_count)
+                    / wave.line_capacity
+                )
+            if wave.weight_capacity:
+                usages.append(
+                    (wave.in_progress_weight + wave.released_weight)
+                    / wave.weight_capacity
+                )
+            wave.capacity_usage = 100.0 * max(usages) if usages else 0.0
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        for vals in vals_list:
+            if vals.get("name", "/") == "/":
+                vals["name"] = self.env["ir.sequence"].next_by_code(
+                    "stock.release.wave"
+                )
+        return super().create(vals_list)
+
+    @api.model
+    def _cron_release_waves(self):
+        picking_types = self.env["stock.picking.type"].search(
+            [
+                "|",
+                ("release_wave_line_capacity", ">", 0),
+                ("release_wave_weight_capacity", ">", 0),
+            ]
+        )
+        for picking_type in picking_types:
+            wave_model = self.with_context(
+                allowed_company_ids=picking_type.company_id.ids
+            )
+            # The moves are selected a first time to know the products to
+            # lock, then the wave is released in a new transaction, started
+            # once the other releases of these products are committed.
+            selection = wave_model.new(
+                wave_model._prepare_wave_values(picking_type)
+            )._select_moves()
+            products = self.env["stock.move"].union(*selection).product_id
+            with self.env["stock.move"]._release_session_lock_products(products):
+                wave_model._release_wave(picking_type, products=products)
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    @api.model
+    def _prepare_wave_values(self, picking_type):
+        # all the released moves count, whether they have been released by a
+        # wave, the release wizard or a release run
+        in_progress = self.env["stock.move"].search(
+            [
+                ("picking_type_id", "=", picking_type.id),
+                ("need_release", "=", False),
+                ("state", "in", IN_PROGRESS_STATES),
+            ]
+        )
+        return {
+            "picking_type_id": picking_type.id,
+            "line_capacity": picking_type.release_wave_line_capacity,
+            "weight_capacity": picking_type.release_wave_weight_capacity,
+            "in_progress_line_count": len(in_progress),
+            "in_progress_weight": sum(
+                move.product_id.weight * move.product_qty for move in in_progress
+            ),
+        }
+
+    @api.model
+    def _release_wave(self, picking_type, products=None):
+        """Release the moves of an operation type up to its capacity
+
+        The moves are released by priority, as long as the lines and weight
+        in progress stay within the capacity of the operation type. When
+        ``products`` is given, only the moves of these products are released,
+        the others wait for the next wave, with all the moves of their
+        transfers shipped all at once.
+        """
+        wave = self.create(self._prepare_wave_values(picking_type))
+        release_quantities = wave._select_moves()
+        if products is not None:
+            skipped_pickings = {
+                move.picking_id
+                for move in release_quantities
+                if move.product_id not in products
+                and move.picking_id.move_type == "one"
+            }
+            release_quantities = {
+                move: qty
+                for move, qty in release_quantities.items()
+                if move.product_id in products
+                and move.picking_id not in skipped_pickings
+            }
+        moves = self.env["stock.move"].browse([move.id for move in release_quantities])
+        if moves:
+            moves.release_available_to_promise()
+            moves.write({"release_wave_id": wave.id})
+        wave.write(
+            {
+                "released_line_count": len(moves),
+                "released_weight": sum(
+                    move.product_id.weight * qty
+                    for move, qty in release_quantities.items()
+                ),
+            }
+        )
+        _logger.info(
+            "release wave %s: %d lines released for %s (usage %.1f%%)",
+            wave.name,
+            len(moves),
+            picking_type.display_name,
+            wave.capacity_usage,
+        )
+        return wave
+
+    def _select_moves(self):
+        """Select the moves to release in the wave, by priority
+
+        Return a dict ``{move: quantity to release}``. The moves of a
+        transfer shipped all at once are selected together. The selection
+        stops at the first move which does not fit in the capacity, so a
+        move never overtakes a move of higher priority. If nothing is in
+        progress, the first move is selected even if it exceeds the capacity.
+        """
+        self.ensure_one()
+        precision = self.env["decimal.precision"].precision_get("Stock Weight")
+        line_room = weight_room = None
+        if self.line_capacity:
+            line_room = self.line_capacity - self.in_progress_line_count
+        if self.weight_capacity:
+            weight_room = self.weight_capacity - self.in_progress_weight
+        is_empty = not self.in_progress_line_count
+        batch_size = max(self.company_id.stock_release_chunk_size, 1)
+        domain = [
+            ("picking_type_id", "=", self.picking_type_id.id),
+            ("need_release", "=", True),
+            ("state", "in", ("confirmed", "waiting")),
+        ]
+        Move = self.env["stock.move"]
+        selected = {}
+        offset = 0
+        while True:
+            candidates = Move.search(
+                domain, order="date_priority, id", limit=batch_size, offset=offset
+            )
+            if not candidates:
+                break
+            offset += len(candidates)
+            # the plan covers all the moves of the transfers shipped all at
+            # once, they are grouped by transfer
+            release_plan = candidates._get_release_plan()
+            picking_plans = defaultdict(dict)
+            for unit_move, plan in release_plan.items():
+                if unit_move.picking_id.move_type == "one":
+                    picking_plans[unit_move.picking_id][unit_move] = plan
+            for move in candidates:
+                if move in selected:
+                    continue
+                if move.picking_id.move_type == "one":
+                    unit_plan = picking_plans[move.picking_id]
+                elif move in release_plan:
+                    unit_plan = {move: release_plan[move]}
+                else:
+                    continue
+                quantities = {
+                    unit_move: plan.release_qty
+                    for unit_move, plan in unit_plan.items()
+                    if plan.outcome in ("full", "partial")
+                }
+                if not quantities:
+                    continue
+                weight = sum(
+                    unit_move.product_id.weight * qty
+                    for unit_move, qty in quantities.items()
+                )
+                fits = (line_room is None or len(quantities) <= line_room) and (
+                    weight_room is None
+                    or float_compare(weight, weight_room, precision_digits=precision)
+                    <= 0
+                )
+                if not fits and not (is_empty and not selected):
+                    return selected
+                selected.update(quantities)
+                if line_room is not None:
+                    line_room -= len(quantities)
+                if weight_room is not None:
+                    weight_room -= weight
+            if (line_room is not None and line_room <= 0) or (
+                weight_room is not None
+                and float_compare(weight_room, 0, precision_digits=precision) <= 0
+            ):
+                break
+        return selected
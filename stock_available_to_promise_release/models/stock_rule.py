@@ -1,8 +1,9 @@
 # Copyright 2019 Camptocamp (https://www.camptocamp.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 import logging
+from collections import defaultdict
 
-from odoo import fields, models
+from odoo import api, fields, models
 
 _logger = logging.getLogger(__name__)
 
@@ -49,18 +50,44 @@ class ProcurementGroup(models.Model):
     _inherit = "procurement.group"
 
     def run_defer(self, procurements):
-        actions_to_run = []
+        rule_cache = {}
+        actions_by_rule = defaultdict(list)
         for procurement in procurements:
             values = procurement.values
             values.setdefault("company_id", self.env.company)
             values.setdefault("priority", "1")
             values.setdefault("date_planned", fields.Datetime.now())
-            rule = self._get_rule(
-                procurement.product_id, procurement.location_id, procurement.values
-            )
+            key = self._get_rule_cache_key(procurement)
+            if key not in rule_cache:
+                rule_cache[key] = self._get_rule(
+                    procurement.product_id, procurement.location_id, values
+                )
+            rule = rule_cache[key]
             if rule.action in ("pull", "pull_push"):
-                actions_to_run.append((procurement, rule))
+                actions_by_rule[rule].append((procurement, rule))
 
-        if actions_to_run:
+        for rule, actions_to_run in actions_by_rule.items():
             rule.with_context(_rule_no_available_defer=True)._run_pull(actions_to_run)
         return True
+
+    @api.model
+    def _get_rule_cache_key(self, procurement):
+        """Key of the procurements for which ``_get_rule`` finds the same rule
+
+        The rule depends on the routes of the product and its category,
+        the routes and warehouse of the procurement values, the location and
+        the company, but not on the product itself.
+        """
+        values = procurement.values
+        product = procurement.product_id
+        route_ids = values.get("route_ids") or ()
+        if isinstance(route_ids, models.BaseModel):
+            route_ids = route_ids.ids
+        warehouse = values.get("warehouse_id")
+        return (
+            frozenset(route_ids),
+            frozenset((product.route_ids | product.categ_id.total_route_ids).ids),
+            procurement.location_id.id,
+            warehouse.id if warehouse else False,
+            values["company_id"].id,
+        )
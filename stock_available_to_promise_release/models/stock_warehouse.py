@@ -0,0 +1,15 @@
+# Copyright 2020 Camptocamp (https://www.camptocamp.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import fields, models
+
+
+class StockWarehouse(models.Model):
+    _inherit = "stock.warehouse"
+
+    stock_reservation_horizon = fields.Integer(
+        string="Stock Reservation Horizon",
+        help="Compute promised quantities for order planned to be shipped "
+        "until this number of days from today. When empty, the horizon of the "
+        "company is used.",
+    )
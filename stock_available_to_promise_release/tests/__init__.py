@@ -1 +1,4 @@
 from . import test_reservation
+from . import test_release_run
+from . import test_release_wave
+from . import test_benchmark
@@ -0,0 +1,159 @@
+# Copyright 2020 Camptocamp (https://www.camptocamp.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Benchmark of the release based on the available to promise
+
+Not run with the standard tests, run it with:
+
+    ATP_BENCH_PRODUCTS=100 ATP_BENCH_WAREHOUSES=3 ATP_BENCH_DELIVERIES=2000 \\
+    odoo -d <db> -i stock_available_to_promise_release \\
+    --test-tags atp_benchmark --stop-after-init
+
+The wall time and number of queries of each step are logged.
+"""
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from odoo.tests import common, tagged
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged("-standard", "atp_benchmark")
+class TestBenchmark(common.SavepointCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.env = cls.env(context=dict(cls.env.context, tracking_disable=True))
+        cls.product_count = int(os.environ.get("ATP_BENCH_PRODUCTS", 10))
+        cls.warehouse_count = int(os.environ.get("ATP_BENCH_WAREHOUSES", 2))
+        cls.delivery_count = int(os.environ.get("ATP_BENCH_DELIVERIES", 50))
+        # the same data for every run
+        cls.random = random.Random(os.environ.get("ATP_BENCH_SEED", 42))
+        cls._generate_data()
+
+    @classmethod
+    def _generate_data(cls):
+        """Generate products, warehouses, stock and open deliveries
+
+        The deliveries have 1 to 5 lines, a priority date spread over 30
+        days and about half of their quantity is in stock.
+        """
+        cls.warehouses = cls.env["stock.warehouse"].create(
+            [
+                {
+                    "name": "Benchmark Warehouse {}".format(index),
+                    "code": "BW{}".format(index),
+                    "reception_steps": "one_step",
+                    "delivery_steps": "pick_ship",
+                }
+                for index in range(cls.warehouse_count)
+            ]
+        )
+        cls.warehouses.delivery_route_id.write(
+            {"available_to_promise_defer_pull": True}
+        )
+        cls.products = cls.env["product.product"].create(
+            [
+                {"name": "Benchmark Product {}".format(index), "type": "product"}
+                for index in range(cls.product_count)
+            ]
+        )
+        Quant = cls.env["stock.quant"]
+        for warehouse in cls.warehouses:
+            for product in cls.products:
+                Quant._update_available_quantity(
+                    product, warehouse.lot_stock_id, cls.random.randint(0, 50)
+                )
+
+        customer_location = cls.env.ref("stock.stock_location_customers")
+        partner = cls.env.ref("base.res_partner_4")
+        start = datetime(2020, 1, 1)
+        groups = cls.env["procurement.group"].create(
+            [
+                {"name": "BENCH{}".format(index), "partner_id": partner.id}
+                for index in range(cls.delivery_count)
+            ]
+        )
+        procurements = []
+        group_dates = {}
+        for group in groups:
+            warehouse = cls.random.choice(cls.warehouses)
+            date_priority = start + timedelta(minutes=cls.random.randint(0, 43200))
+            group_dates[group] = date_priority
+            values = {
+                "company_id": warehouse.company_id,
+                "group_id": group,
+                "date_planned": date_priority,
+                "warehouse_id": warehouse,
+            }
+            line_count = min(cls.random.randint(1, 5), len(cls.products))
+            for product_id in cls.random.sample(cls.products.ids, line_count):
+                product = cls.products.browse(product_id)
+                procurements.append(
+                    groups.Procurement(
+                        product,
+                        cls.random.randint(1, 10),
+                        product.uom_id,
+                        customer_location,
+                        group.name,
+                        group.name,
+                        warehouse.company_id,
+                        values,
+                    )
+                )
+        cls.env["procurement.group"].run(procurements)
+        cls.moves = cls.env["stock.move"].search(
+            [("group_id", "in", groups.ids), ("need_release", "=", True)]
+        )
+        for group, date_priority in group_dates.items():
+            cls.moves.filtered(lambda move: move.group_id == group).write(
+                {"date_priority": date_priority}
+            )
+        cls.env["base"].flush()
+        _logger.info(
+            "benchmark data: %d products, %d warehouses, %d deliveries, %d moves",
+            cls.product_count,
+            cls.warehouse_count,
+            cls.delivery_count,
+            len(cls.moves),
+        )
+
+    @contextmanager
+    def _measure(self, name):
+        self.env["base"].flush()
+        self.env["base"].invalidate_cache()
+        query_count = self.env.cr.sql_log_count
+        start = time.perf_counter()
+        yield
+        self.env["base"].flush()
+        _logger.info(
+            "benchmark %s: %.3fs, %d queries",
+            name,
+            time.perf_counter() - start,
+            self.env.cr.sql_log_count - query_count,
+        )
+
+    def test_benchmark(self):
+        moves = self.moves
+        with self._measure("_ordered_available_to_promise, move by move"):
+            single = {move.id: move._ordered_available_to_promise() for move in moves}
+        with self._measure("_get_ordered_available_to_promise, batch"):
+            batch = moves._get_ordered_available_to_promise()
+        for move_id, quantity in single.items():
+            self.assertAlmostEqual(batch[move_id], quantity)
+
+        # release one half directly and the other half with the wizard
+        half = len(moves) // 2
+        with self._measure("_run_stock_rule ({} moves)".format(half)):
+            moves[:half]._run_stock_rule()
+        wizard = (
+            self.env["stock.move.release"]
+            .with_context(active_model="stock.move", active_ids=moves[half:].ids)
+            .create({})
+        )
+        with self._measure("release wizard ({} moves)".format(len(moves) - half)):
+            wizard.release()
@@ -0,0 +1,294 @@
+# Copyright 2020 Camptocamp (https://www.camptocamp.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from datetime import datetime
+from unittest import mock
+
+from psycopg2.extensions import TransactionRollbackError
+
+from odoo import SUPERUSER_ID, api
+from odoo.exceptions import UserError
+from odoo.tools import mute_logger
+
+from .common import PromiseReleaseCommonCase
+
+
+class TestReleaseRun(PromiseReleaseCommonCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        cls.env["stock.quant"]._update_available_quantity(
+            cls.product1, cls.loc_bin1, 20.0
+        )
+        cls.env["stock.quant"]._update_available_quantity(
+            cls.product2, cls.loc_bin1, 20.0
+        )
+
+    def test_release_in_background(self):
+        picking1 = self._create_picking_chain(self.wh, [(self.product1, 5)])
+        picking2 = self._create_picking_chain(self.wh, [(self.product2, 5)])
+        run = (picking1 | picking2).release_available_to_promise_in_background()
+        run.chunk_size = 1
+        self.assertRecordValues(
+            run, [{"state": "queued", "move_count": 2, "processed_count": 0}]
+        )
+        # nothing released yet
+        self.assertTrue(picking1.need_release)
+        self.assertTrue(picking2.need_release)
+        run._process()
+        self.assertRecordValues(
+            run,
+            [
+                {
+                    "state": "done",
+                    "move_count": 2,
+                    "processed_count": 2,
+                    "failed_count": 0,
+                    "progress": 100.0,
+                }
+            ],
+        )
+        self.assertFalse(picking1.need_release)
+        self.assertFalse(picking2.need_release)
+
+    def test_release_in_background_multi_company(self):
+        company2 = self.env["res.company"].create({"name": "Release Company 2"})
+        wh2 = self.env["stock.warehouse"].search([("company_id", "=", company2.id)])
+        picking1 = self._create_picking_chain(self.wh, [(self.product1, 5)])
+        move2 = self.env["stock.move"].create(
+            {
+                "name": "company 2",
+                "company_id": company2.id,
+                "product_id": self.product1.id,
+                "product_uom_qty": 5.0,
+                "product_uom": self.product1.uom_id.id,
+                "location_id": wh2.lot_stock_id.id,
+                "location_dest_id": self.loc_customer.id,
+                "warehouse_id": wh2.id,
+                "need_release": True,
+            }
+        )
+        runs = (
+            picking1.move_lines | move2
+        ).release_available_to_promise_in_background()
+        # the moves are released in the context of the company of their run
+        self.assertRecordValues(
+            runs.sorted("id"),
+            [
+                {"company_id": self.env.company.id, "move_count": 1},
+                {"company_id": company2.id, "move_count": 1},
+            ],
+        )
+        self.assertEqual(
+            runs.filtered(lambda run: run.company_id == company2).queue_ids.move_id,
+            move2,
+        )
+        self.assertEqual(runs.action_view_runs()["domain"], [("id", "in", runs.ids)])
+
+    def test_release_in_background_failure(self):
+        picking1 = self._create_picking_chain(self.wh, [(self.product1, 5)])
+        picking2 = self._create_picking_chain(self.wh, [(self.product2, 5)])
+        run = (picking1 | picking2).release_available_to_promise_in_background()
+        failing_move = picking1.move_lines
+        StockMove = type(self.env["stock.move"])
+        release = StockMove.release_available_to_promise
+
+        def release_or_fail(moves):
+            if failing_move in moves:
+                raise UserError("Release failed")
+            return release(moves)
+
+        with mock.patch.object(
+            StockMove, "release_available_to_promise", release_or_fail
+        ):
+            run._process()
+        self.assertRecordValues(
+            run, [{"state": "done", "processed_count": 2, "failed_count": 1}]
+        )
+        failed = run.queue_ids.filtered(lambda item: item.state == "failed")
+        self.assertEqual(failed.move_id, failing_move)
+        self.assertIn("Release failed", failed.error)
+        self.assertTrue(picking1.need_release)
+        self.assertFalse(picking2.need_release)
+
+        run.action_retry_failed()
+        self.assertEqual(run.state, "queued")
+        run._process()
+        self.assertEqual(run.failed_count, 0)
+        self.assertFalse(picking1.need_release)
+
+    def test_product_partitions(self):
+        product3 = self.env["product.product"].create(
+            {"name": "Product 3", "type": "product"}
+        )
+        product4 = self.env["product.product"].create(
+            {"name": "Product 4", "type": "product"}
+        )
+        pickings1 = self._create_picking_chain(
+            self.wh, [(self.product1, 1), (self.product2, 1)]
+        )
+        pickings2 = self._create_picking_chain(
+            self.wh, [(self.product2, 1), (product3, 1)]
+        )
+        pickings3 = self._create_picking_chain(self.wh, [(product4, 1)])
+        pickings = pickings1 | pickings2 | pickings3
+        run = pickings.release_available_to_promise_in_background()
+        partitions = run._product_partitions(2)
+        # the products linked by procurement groups are released by the same
+        # worker
+        self.assertEqual(
+            sorted(partitions),
+            sorted(
+                [sorted((self.product1 | self.product2 | product3).ids), product4.ids,]
+            ),
+        )
+        # never more partitions than connected products
+        self.assertEqual(len(run._product_partitions(5)), 2)
+        for product_ids in partitions:
+            run._process_chunks(product_ids=product_ids)
+        self.assertEqual(run.processed_count, 5)
+        self.assertFalse(pickings.filtered("need_release"))
+
+    def test_release_lock_products_concurrent(self):
+        with self.registry.cursor() as cr1, self.registry.cursor() as cr2:
+            env1 = api.Environment(cr1, SUPERUSER_ID, {})
+            products = env1["product.product"].search([], limit=2, order="id")
+            if len(products) < 2:
+                self.skipTest("two products must exist in the database")
+            # the locks are committed, the products are restored at the end
+            cr1.execute(
+                "SELECT id, last_release_date FROM product_product WHERE id IN %s",
+                (tuple(products.ids),),
+            )
+            release_dates = cr1.fetchall()
+            try:
+                self._check_release_lock_products_concurrent(cr1, cr2, products)
+            finally:
+                cr1.rollback()
+                cr2.rollback()
+                for product_id, release_date in release_dates:
+                    cr1.execute(
+                        "UPDATE product_product SET last_release_date = %s "
+                        "WHERE id = %s",
+                        (release_date, product_id),
+                    )
+                cr1.commit()
+
+    def _check_release_lock_products_concurrent(self, cr1, cr2, products):
+        env1 = api.Environment(cr1, SUPERUSER_ID, {})
+        env2 = api.Environment(cr2, SUPERUSER_ID, {})
+        products = products.with_env(env1)
+        product = env2["product.product"].browse(products[1].id)
+        # the snapshot of the second transaction is taken now
+        cr2.execute("SELECT 1")
+        env1["stock.move"]._release_lock_products(products)
+        # a product cannot be released by two transactions
+        with self.assertRaises(UserError):
+            env2["stock.move"]._release_lock_products(product)
+        cr1.commit()
+        # the release has been committed after the snapshot of the second
+        # transaction was taken, it has to be retried
+        with mute_logger("odoo.sql_db"), self.assertRaises(TransactionRollbackError):
+            env2["stock.move"]._release_lock_products(product)
+        cr2.rollback()
+        env2["stock.move"]._release_lock_products(product)
+        cr2.rollback()
+
+        # the session locks are held across the transactions of the block
+        with env1["stock.move"]._release_session_lock_products(products):
+            with self.assertRaises(UserError):
+                env2["stock.move"]._release_lock_products(product)
+            cr2.rollback()
+            cr1.commit()
+            with self.assertRaises(UserError):
+                env2["stock.move"]._release_lock_products(product)
+            cr2.rollback()
+        env2["stock.move"]._release_lock_products(product)
+        cr2.rollback()
+
+    def _receive(self, product, quantity):
+        move = self.env["stock.move"].create(
+            {
+                "name": "receipt",
+                "product_id": product.id,
+                "product_uom_qty": quantity,
+                "product_uom": product.uom_id.id,
+                "location_id": self.env.ref("stock.stock_location_suppliers").id,
+                "location_dest_id": self.loc_bin1.id,
+            }
+        )
+        move._action_confirm()
+        move._action_assign()
+        move.quantity_done = quantity
+        move._action_done()
+
+    def test_enqueue_on_stock_arrival(self):
+        product3 = self.env["product.product"].create(
+            {"name": "Product 3", "type": "product"}
+        )
+        picking1 = self._create_picking_chain(
+            self.wh, [(product3, 5)], date=datetime(2019, 9, 3)
+        )
+        picking2 = self._create_picking_chain(
+            self.wh, [(product3, 5)], date=datetime(2019, 9, 2)
+        )
+        picking3 = self._create_picking_chain(self.wh, [(self.product1, 5)])
+        # option disabled
+        self._receive(product3, 10)
+        self.assertFalse(
+            self.env["stock.release.run"].search([("trigger", "=", "stock_arrival")])
+        )
+        self.env.company.stock_release_on_stock_arrival = True
+        self._receive(product3, 10)
+        run = self.env["stock.release.run"].search([("trigger", "=", "stock_arrival")])
+        self.assertEqual(len(run), 1)
+        # ordered by priority date, no move of other products
+        self.assertEqual(
+            run.queue_ids.move_id.ids, (picking2 | picking1).move_lines.ids
+        )
+        # already queued moves are not queued again
+        self._receive(product3, 10)
+        self.assertEqual(len(run.queue_ids), 2)
+        self._receive(self.product1, 10)
+        self.assertEqual(len(run.queue_ids), 3)
+        self.assertIn(picking3.move_lines, run.queue_ids.move_id)
+        run._process()
+        self.assertFalse((picking1 | picking2 | picking3).filtered("need_release"))
+
+    def test_enqueue_on_stock_arrival_grouped_by_location(self):
+        picking1 = self._create_picking_chain(self.wh, [(self.product1, 5)])
+        picking2 = self._create_picking_chain(self.wh, [(self.product2, 5)])
+        moves = self.env["stock.move"].create(
+            [
+                {
+                    "name": "receipt",
+                    "product_id": product.id,
+                    "product_uom_qty": 10.0,
+                    "product_uom": product.uom_id.id,
+                    "location_id": self.env.ref("stock.stock_location_suppliers").id,
+                    "location_dest_id": self.loc_bin1.id,
+                }
+                for product in (self.product1, self.product2)
+            ]
+        )
+        moves._action_confirm()
+        moves._action_assign()
+        for move in moves:
+            move.quantity_done = 10.0
+        moves._action_done()
+        self.env.company.stock_release_on_stock_arrival = True
+        location_class = type(self.env["stock.location"])
+        with mock.patch.object(
+            location_class,
+            "get_warehouse",
+            autospec=True,
+            side_effect=location_class.get_warehouse,
+        ) as get_warehouse:
+            moves._release_enqueue_on_stock_arrival()
+        # the warehouse is searched once for the moves to the same location
+        self.assertEqual(get_warehouse.call_count, 1)
+        run = self.env["stock.release.run"].search([("trigger", "=", "stock_arrival")])
+        self.assertEqual(
+            run.queue_ids.move_id, (picking1 | picking2).move_lines,
+        )
@@ -0,0 +1,122 @@
+# Copyright 2020 Camptocamp (https://www.camptocamp.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from unittest import mock
+
+from .common import PromiseReleaseCommonCase
+
+
+class TestReleaseWave(PromiseReleaseCommonCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        cls.env["stock.quant"]._update_available_quantity(
+            cls.product1, cls.loc_bin1, 20.0
+        )
+        cls.picking_type = cls.wh.out_type_id
+
+    def _create_pickings(self):
+        pickings = self.env["stock.picking"]
+        for day in ("01", "02", "03"):
+            pickings |= self._create_picking_chain(
+                self.wh, [(self.product1, 5)], date="2019-10-{}".format(day)
+            )
+        return pickings
+
+    def _release_wave(self):
+        return self.env["stock.release.wave"]._release_wave(self.picking_type)
+
+    def test_release_wave_lines(self):
+        self.picking_type.release_wave_line_capacity = 2
+        picking1, picking2, picking3 = self._create_pickings()
+        wave = self._release_wave()
+        self.assertRecordValues(
+            wave,
+            [
+                {
+                    "line_capacity": 2,
+                    "in_progress_line_count": 0,
+                    "released_line_count": 2,
+                    "capacity_usage": 100.0,
+                }
+            ],
+        )
+        self.assertEqual(wave.move_ids, (picking1 | picking2).move_lines)
+        self.assertFalse(picking1.need_release)
+        self.assertFalse(picking2.need_release)
+        self.assertTrue(picking3.need_release)
+
+        # the floor is full
+        wave = self._release_wave()
+        self.assertRecordValues(
+            wave, [{"in_progress_line_count": 2, "released_line_count": 0}]
+        )
+
+        # once the goods of the first transfer are picked, a line is released
+        pick = self._pickings_in_group(picking1.group_id) - picking1
+        pick.move_lines.quantity_done = 5
+        pick.action_done()
+        self.assertEqual(picking1.move_lines.state, "assigned")
+        wave = self._release_wave()
+        self.assertRecordValues(
+            wave, [{"in_progress_line_count": 1, "released_line_count": 1}]
+        )
+        self.assertFalse(picking3.need_release)
+
+    def test_release_wave_in_progress_other_releases(self):
+        self.picking_type.release_wave_line_capacity = 2
+        picking1, picking2, picking3 = self._create_pickings()
+        # the moves released without wave count in the lines in progress
+        picking1.release_available_to_promise()
+        wave = self._release_wave()
+        self.assertRecordValues(
+            wave, [{"in_progress_line_count": 1, "released_line_count": 1}]
+        )
+        self.assertEqual(wave.move_ids, picking2.move_lines)
+        self.assertTrue(picking3.need_release)
+
+    def test_release_wave_weight(self):
+        self.product1.weight = 2.0
+        self.picking_type.release_wave_weight_capacity = 15.0
+        pickings = self._create_pickings()
+        wave = self._release_wave()
+        self.assertRecordValues(
+            wave, [{"released_line_count": 1, "released_weight": 10.0}],
+        )
+        self.assertEqual(wave.move_ids, pickings[0].move_lines)
+
+    def test_release_wave_all_at_once(self):
+        self.env["stock.quant"]._update_available_quantity(
+            self.product2, self.loc_bin1, 20.0
+        )
+        self.picking_type.release_wave_line_capacity = 2
+        picking = self._create_picking_chain(
+            self.wh, [(self.product1, 5), (self.product2, 5)], move_type="one"
+        )
+        move_class = type(self.env["stock.move"])
+        with mock.patch.object(
+            move_class,
+            "_get_release_plan",
+            autospec=True,
+            side_effect=move_class._get_release_plan,
+        ) as get_release_plan:
+            wave = self._release_wave()
+        # the transfer is planned with the selection, then by its release
+        self.assertEqual(get_release_plan.call_count, 2)
+        self.assertEqual(wave.move_ids, picking.move_lines)
+        self.assertFalse(picking.need_release)
+
+    def test_release_wave_locked_products(self):
+        self.picking_type.release_wave_line_capacity = 2
+        picking1, picking2, picking3 = self._create_pickings()
+        # the moves of the products which are not locked wait for the next wave
+        wave = self.env["stock.release.wave"]._release_wave(
+            self.picking_type, products=self.env["product.product"]
+        )
+        self.assertRecordValues(wave, [{"released_line_count": 0}])
+        self.assertTrue(picking1.need_release)
+        wave = self.env["stock.release.wave"]._release_wave(
+            self.picking_type, products=self.product1
+        )
+        self.assertEqual(wave.move_ids, (picking1 | picking2).move_lines)
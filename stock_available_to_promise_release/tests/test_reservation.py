@@ -1,11 +1,15 @@
 # Copyright 2019 Camptocamp (https://www.camptocamp.com)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+from collections import OrderedDict
 from datetime import datetime
+from unittest import mock
 
 from dateutil.relativedelta import relativedelta
 from freezegun import freeze_time
 
+from ..models import product_product
+from ..models.stock_picking import SEARCH_OPERATORS
 from .common import PromiseReleaseCommonCase
 
 
@@ -22,6 +26,28 @@ class TestAvailableToPromiseRelease(PromiseReleaseCommonCase):
             line.qty_done = line.product_qty
         picking.action_done()
 
+    def _check_release_ratio_search(self, pickings):
+        """The search computes the same ratios as the field, in SQL"""
+        pickings.invalidate_cache(fnames=["release_ratio"])
+        for operator, value in (
+            ("=", 0.0),
+            ("!=", 0.0),
+            (">", 0.0),
+            (">=", 35.0),
+            ("<", 35.0),
+            ("<=", 100.0),
+        ):
+            self.assertEqual(
+                self.env["stock.picking"].search(
+                    [("id", "in", pickings.ids), ("release_ratio", operator, value)]
+                ),
+                pickings.filtered(
+                    lambda picking: SEARCH_OPERATORS[operator](
+                        picking.release_ratio, value
+                    )
+                ),
+            )
+
     def test_qty_ctx(self):
         move = self.env["stock.move"].create(
             {
@@ -128,6 +154,331 @@ class TestAvailableToPromiseRelease(PromiseReleaseCommonCase):
             # last picking won't have available qty again
             self.assertEqual(picking4.move_lines._ordered_available_to_promise(), 0)
 
+    def test_warehouse_horizon(self):
+        self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        picking = self._create_picking_chain(
+            self.wh, [(self.product1, 5)], date=datetime(2019, 9, 2, 16, 0)
+        )
+        picking2 = self._create_picking_chain(
+            self.wh, [(self.product1, 5)], date=datetime(2019, 9, 3, 16, 0)
+        )
+        self._update_qty_in_location(self.loc_bin1, self.product1, 5.0)
+        moves = (picking | picking2).move_lines
+        self.env.company.stock_reservation_horizon = 10
+        self.wh.stock_reservation_horizon = 1
+        with freeze_time("2019-09-03"):
+            self.assertEqual(
+                picking.move_lines._promise_reservation_horizon_date(),
+                datetime(2019, 9, 4, 23, 59, 59, 999999),
+            )
+            picking.move_lines.write({"date_expected": "2019-09-10"})
+            # the first move is beyond the horizon of the warehouse
+            self.assertEqual(
+                moves._get_ordered_available_to_promise(),
+                {picking.move_lines.id: 5.0, picking2.move_lines.id: 5.0},
+            )
+            # the horizon of the company applies
+            self.wh.stock_reservation_horizon = 0
+            self.assertEqual(
+                moves._get_ordered_available_to_promise(),
+                {picking.move_lines.id: 5.0, picking2.move_lines.id: 0.0},
+            )
+            # the horizon of the company of the warehouse, whatever the
+            # current company
+            other_company = self.env["res.company"].create({"name": "Other"})
+            other_company.stock_reservation_horizon = 20
+            Move = self.env["stock.move"].with_context(
+                allowed_company_ids=[other_company.id, self.wh.company_id.id]
+            )
+            self.assertEqual(
+                Move._promise_reservation_horizons(self.wh),
+                {False: 20, self.wh.id: 10},
+            )
+
+    def test_ordered_available_to_promise_batch(self):
+        self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        pickings = self.env["stock.picking"].browse()
+        for qty, date in (
+            (5, datetime(2019, 9, 2, 16, 0)),
+            (3, datetime(2019, 9, 3, 16, 1)),
+            # same priority than the previous one
+            (4, datetime(2019, 9, 3, 16, 1)),
+            (20, datetime(2019, 9, 4, 16, 0)),
+            (20, datetime(2019, 9, 5, 16, 1)),
+        ):
+            pickings |= self._out_picking(
+                self._create_picking_chain(
+                    self.wh, [(self.product1, qty), (self.product2, qty)], date=date
+                )
+            )
+        self._update_qty_in_location(self.loc_bin1, self.product1, 20.0)
+        self._update_qty_in_location(self.loc_bin1, self.product2, 10.0)
+        moves = pickings.move_lines
+
+        def assert_batch_equal_per_move():
+            quantities = moves._get_ordered_available_to_promise()
+            for move in moves:
+                self.assertEqual(
+                    quantities[move.id], move._ordered_available_to_promise()
+                )
+
+        assert_batch_equal_per_move()
+        quantities = moves._get_ordered_available_to_promise()
+        self.assertEqual(
+            [
+                quantities[move.id]
+                for picking in pickings
+                for move in picking.move_lines
+                if move.product_id == self.product1
+            ],
+            [5, 3, 4, 8, 0],
+        )
+        self.env.company.stock_reservation_horizon = 1
+        with freeze_time("2019-09-03"):
+            pickings[1].move_lines.write({"date_expected": "2019-09-10"})
+            assert_batch_equal_per_move()
+
+    def test_ordered_available_to_promise_batch_qty_ctx(self):
+        self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        picking = self._out_picking(
+            self._create_picking_chain(self.wh, [(self.product1, 5)])
+        )
+        self._update_qty_in_location(self.loc_bin1, self.product1, 3.0)
+        move = picking.move_lines
+
+        def qty_ctx(move):
+            return {"warehouse": move.warehouse_id.id}
+
+        with mock.patch.object(
+            type(move), "_order_available_to_promise_qty_ctx", qty_ctx
+        ):
+            # the snapshot cannot read the stock of such a context, the
+            # quantity of the move is computed by the ORM
+            self.assertNotIn(move.id, move._get_ordered_available_to_promise())
+            self.assertEqual(move.ordered_available_to_promise, 3)
+
+    def test_ordered_available_to_promise_memo(self):
+        self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        self._update_qty_in_location(self.loc_bin1, self.product1, 4.0)
+        picking = self._out_picking(
+            self._create_picking_chain(self.wh, [(self.product1, 5)])
+        )
+        move = picking.move_lines
+        self.assertEqual(move.ordered_available_to_promise, 4)
+        # the value is kept in cache for the transaction
+        with self.assertQueryCount(0):
+            self.assertEqual(move.ordered_available_to_promise, 4)
+        # until the stock changes
+        self._update_qty_in_location(self.loc_bin1, self.product1, 6.0)
+        self.assertEqual(move.ordered_available_to_promise, 5)
+        # or the move is released
+        move.release_available_to_promise()
+        self.assertEqual(move.ordered_available_to_promise, 0)
+
+    def test_ordered_available_to_promise_by_warehouse(self):
+        self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        self._update_qty_in_location(self.loc_bin1, self.product1, 20.0)
+        picking = self._create_picking_chain(
+            self.wh, [(self.product1, 5)], date=datetime(2019, 9, 2, 16, 0)
+        )
+        self._create_picking_chain(
+            self.wh, [(self.product1, 8)], date=datetime(2019, 9, 4, 16, 0)
+        )
+        products = self.product1 | self.product2
+        wh1, wh2 = self.wh.id, self.env.ref("stock.warehouse0").id
+        warehouses = self.env["stock.warehouse"].browse([wh1, wh2])
+        self.env["stock.quant"]._update_available_quantity(
+            self.product2, self.env.ref("stock.stock_location_stock"), 3.0
+        )
+        result = products._get_ordered_available_to_promise_by_warehouse(warehouses)
+        self.assertEqual(result[(self.product1.id, wh1)], 7.0)
+        self.assertEqual(result[(self.product2.id, wh1)], 0.0)
+        self.assertEqual(result[(self.product2.id, wh2)], 3.0)
+        result = products._get_ordered_available_to_promise_by_warehouse(
+            warehouses, date_priority=datetime(2019, 9, 3)
+        )
+        self.assertEqual(result[(self.product1.id, wh1)], 15.0)
+
+        # served from the cache
+        query_count = self.env.cr.sql_log_count
+        products._get_ordered_available_to_promise_by_warehouse(warehouses)
+        self.assertEqual(self.env.cr.sql_log_count, query_count)
+        # even after a change of a move which promises the same quantities
+        picking.move_lines.write({"name": "Renamed"})
+        self.env["base"].flush()
+        query_count = self.env.cr.sql_log_count
+        products._get_ordered_available_to_promise_by_warehouse(warehouses)
+        self.assertEqual(self.env.cr.sql_log_count, query_count)
+        # a change of stock invalidates the cache
+        self._update_qty_in_location(self.loc_bin1, self.product1, 5.0)
+        result = products._get_ordered_available_to_promise_by_warehouse(warehouses)
+        self.assertEqual(result[(self.product1.id, wh1)], 12.0)
+
+    def test_promisable_cache_eviction(self):
+        cache = OrderedDict(
+            [("expired", (5.0, 1.0)), ("old", (20.0, 2.0)), ("new", (30.0, 3.0))]
+        )
+        Product = self.env["product.product"]
+        Product._evict_promisable_cache(cache, 10.0)
+        self.assertEqual(list(cache), ["old", "new"])
+        with mock.patch.object(product_product, "PROMISABLE_CACHE_SIZE", 1):
+            Product._evict_promisable_cache(cache, 10.0)
+        self.assertEqual(list(cache), ["new"])
+
+    def test_stock_on_hand_snapshot(self):
+        self._update_qty_in_location(self.loc_stock, self.product1, 3.0)
+        self._update_qty_in_location(self.loc_bin1, self.product1, 7.0)
+        self._update_qty_in_location(self.loc_bin1, self.product2, 5.0)
+        # not in the stock of the warehouse
+        self._update_qty_in_location(
+            self.wh.wh_output_stock_loc_id, self.product2, 11.0
+        )
+        locations = self.loc_stock | self.loc_bin1
+        products = self.product1 | self.product2
+        snapshot = self.env["stock.move"]._get_stock_on_hand_snapshot(
+            products, locations
+        )
+        for location in locations:
+            for product in products.with_context(location=location.id):
+                self.assertEqual(
+                    snapshot.get((product.id, location.id), 0.0), product.qty_available,
+                )
+        self.assertEqual(snapshot[(self.product1.id, self.loc_stock.id)], 10.0)
+        self.assertEqual(snapshot[(self.product2.id, self.loc_stock.id)], 5.0)
+
+    def test_promise_ledger(self):
+        self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        self._update_qty_in_location(self.loc_bin1, self.product1, 7.0)
+        cust_picking = self._create_picking_chain(self.wh, [(self.product1, 20)])
+        self.assertEqual(cust_picking.move_lines.promised_unreserved_qty, 20.0)
+        cust_picking.release_available_to_promise()
+        out_picking = self._pickings_in_group(cust_picking.group_id).filtered(
+            lambda picking: picking.picking_type_code != "outgoing"
+        )
+        # the released quantity is reserved on the pick move
+        self.assertEqual(out_picking.move_lines.promised_unreserved_qty, 0.0)
+        self.assertEqual(cust_picking.move_lines.promised_unreserved_qty, 7.0)
+        self.assertEqual(
+            cust_picking.backorder_ids.move_lines.promised_unreserved_qty, 13.0
+        )
+        moves = self._pickings_in_group(cust_picking.group_id).move_lines
+        self.assertFalse(self.env["stock.move"]._check_promise_ledger(moves))
+
+        self.env["base"].flush()
+        self.env.cr.execute(
+            "UPDATE stock_move SET promised_unreserved_qty = 0 WHERE id IN %s",
+            (tuple(moves.ids),),
+        )
+        moves.invalidate_cache(fnames=["promised_unreserved_qty"])
+        self.assertEqual(len(self.env["stock.move"]._check_promise_ledger(moves)), 2)
+        self.env["stock.move"]._rebuild_promise_ledger()
+        self.assertFalse(self.env["stock.move"]._check_promise_ledger(moves))
+
+    def test_promise_indexes(self):
+        self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        picking = self._create_picking_chain(self.wh, [(self.product1, 5)])
+        self._create_picking_chain(self.wh, [(self.product2, 5)])
+        # moves which never promise anything, the partial indexes skip them
+        self.env["stock.move"].create(
+            [
+                {
+                    "name": "seed",
+                    "product_id": self.product1.id,
+                    "product_uom": self.uom_unit.id,
+                    "product_uom_qty": 1.0,
+                    "location_id": self.loc_stock.id,
+                    "location_dest_id": self.loc_customer.id,
+                    "warehouse_id": self.wh.id,
+                }
+                for __ in range(200)
+            ]
+        )
+        self.env["base"].flush()
+        query, params = picking.move_lines._get_previous_promised_qty_query()
+        self.env.cr.execute("ANALYZE stock_move")
+        self.env.cr.execute("SET enable_seqscan = off")
+        try:
+            self.env.cr.execute("EXPLAIN " + query, params)
+            plan = "\n".join(row[0] for row in self.env.cr.fetchall())
+        finally:
+            self.env.cr.execute("RESET enable_seqscan")
+        self.assertIn("stock_move_promise_need_release_index", plan)
+        self.assertIn("stock_move_promise_released_index", plan)
+
+    def test_release_statistics(self):
+        self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        self._update_qty_in_location(self.loc_bin1, self.product1, 7.0)
+        self._update_qty_in_location(self.loc_bin1, self.product2, 10.0)
+        cust_picking = self._create_picking_chain(
+            self.wh, [(self.product1, 20), (self.product2, 10)]
+        )
+        Statistics = self.env["stock.release.statistics"]
+        cust_picking.release_available_to_promise()
+        self.assertFalse(Statistics.search([]))
+
+        self.env.company.stock_release_statistics = True
+        self._update_qty_in_location(self.loc_bin1, self.product1, 20.0)
+        cust_picking.backorder_ids.release_available_to_promise()
+        statistics = Statistics.search([])
+        self.assertRecordValues(
+            statistics,
+            [{"move_count": 1, "released_move_count": 1, "split_move_count": 0}],
+        )
+        self.assertGreater(statistics.query_count, 0)
+        self.assertGreater(statistics.procurement_query_count, 0)
+
+    def test_release_plan(self):
+        self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        self._update_qty_in_location(self.loc_bin1, self.product1, 7.0)
+        self._update_qty_in_location(self.loc_bin1, self.product2, 3.0)
+        picking_partial = self._create_picking_chain(
+            self.wh, [(self.product1, 20)], date="2019-10-01"
+        )
+        picking_one = self._create_picking_chain(
+            self.wh, [(self.product2, 5)], date="2019-10-02", move_type="one"
+        )
+        # the stock of product1 is promised to the first picking
+        picking_nothing = self._create_picking_chain(
+            self.wh, [(self.product1, 5)], date="2019-10-03"
+        )
+        pickings = picking_partial | picking_one | picking_nothing
+        plan = pickings.move_lines._get_release_plan()
+        self.assertEqual(plan[picking_partial.move_lines], (7.0, 7.0, 13.0, "partial"))
+        self.assertEqual(plan[picking_one.move_lines], (3.0, 0.0, 5.0, "all_at_once"))
+        self.assertEqual(plan[picking_nothing.move_lines], (0.0, 0.0, 5.0, "nothing"))
+        self.assertTrue(pickings._get_release_plan()[picking_partial]["backorder"])
+
+        wizard = (
+            self.env["stock.release.plan"]
+            .with_context(active_model="stock.picking", active_ids=pickings.ids)
+            .create({})
+        )
+        self.assertRecordValues(
+            wizard,
+            [
+                {
+                    "full_count": 0,
+                    "partial_count": 1,
+                    "not_released_count": 2,
+                    "backorder_count": 1,
+                }
+            ],
+        )
+        # the preview does not release anything
+        self.assertFalse(pickings.backorder_ids)
+        self.assertEqual(self._pickings_in_group(pickings.group_id), pickings)
+        self.assertTrue(all(pickings.move_lines.mapped("need_release")))
+
+        # the pickings are released as from their own action, which cleans up
+        # the defaults set in the context by the sale orders
+        picking_class = type(self.env["stock.picking"])
+        with mock.patch.object(
+            picking_class, "release_available_to_promise", autospec=True
+        ) as release:
+            wizard.with_context(default_origin="SO001").release()
+        release.assert_called_once()
+        self.assertEqual(release.call_args[0][0], pickings)
+
     def test_normal_chain(self):
         # usual scenario, without using the option to defer the pull
         pickings = self._create_picking_chain(self.wh, [(self.product1, 5)])
@@ -146,6 +497,95 @@ class TestAvailableToPromiseRelease(PromiseReleaseCommonCase):
             ],
         )
 
+    def test_release_get_chain(self):
+        pickings = self._create_picking_chain(self.wh, [(self.product1, 5)])
+        pick_picking, cust_picking = pickings.sorted("id")
+        Move = self.env["stock.move"]
+        chain = Move._release_get_chain(cust_picking.move_lines)
+        self.assertEqual(chain, [cust_picking.move_lines, pick_picking.move_lines])
+        # a cycle in the chain does not loop forever
+        pick_picking.move_lines.move_orig_ids = cust_picking.move_lines
+        chain = Move._release_get_chain(cust_picking.move_lines)
+        self.assertEqual(chain, [cust_picking.move_lines, pick_picking.move_lines])
+        Move._release_set_printed(cust_picking.move_lines, chain=chain)
+        self.assertTrue(all(pickings.mapped("printed")))
+
+    def test_rule_cache_key(self):
+        group = self.env["procurement.group"]
+
+        def procurement(product):
+            return group.Procurement(
+                product,
+                1.0,
+                product.uom_id,
+                self.loc_customer,
+                "TEST",
+                "TEST",
+                self.wh.company_id,
+                {"company_id": self.wh.company_id, "warehouse_id": self.wh},
+            )
+
+        key1 = group._get_rule_cache_key(procurement(self.product1))
+        self.assertEqual(key1, group._get_rule_cache_key(procurement(self.product2)))
+        self.product2.route_ids = self.wh.delivery_route_id
+        self.assertNotEqual(key1, group._get_rule_cache_key(procurement(self.product2)))
+
+    def test_run_defer_rules(self):
+        output = self.wh.wh_output_stock_loc_id
+        pick_rule = self.wh.delivery_route_id.rule_ids.filtered(
+            lambda rule: rule.location_id == output
+        )
+        route = self.env["stock.location.route"].create(
+            {
+                "name": "Pick from Bin1",
+                "product_selectable": True,
+                "rule_ids": [
+                    (
+                        0,
+                        0,
+                        {
+                            "name": "Bin1 to Output",
+                            "action": "pull",
+                            "location_id": output.id,
+                            "location_src_id": self.loc_bin1.id,
+                            "picking_type_id": self.wh.pick_type_id.id,
+                            "procure_method": "make_to_stock",
+                        },
+                    )
+                ],
+            }
+        )
+        self.product2.route_ids = route
+        group = self.env["procurement.group"].create({"name": "TEST"})
+        values = {
+            "company_id": self.wh.company_id,
+            "group_id": group,
+            "warehouse_id": self.wh,
+        }
+        procurements = [
+            group.Procurement(
+                product,
+                1.0,
+                product.uom_id,
+                output,
+                "TEST",
+                "TEST",
+                self.wh.company_id,
+                dict(values),
+            )
+            for product in (self.product1, self.product2, self.product1)
+        ]
+        self.env["procurement.group"].run_defer(procurements)
+        moves = self.env["stock.move"].search([("group_id", "=", group.id)])
+        # each procurement creates its move from its own rule (the moves of
+        # the same product are merged)
+        moves1 = moves.filtered(lambda move: move.product_id == self.product1)
+        moves2 = moves.filtered(lambda move: move.product_id == self.product2)
+        self.assertEqual(moves1.rule_id, pick_rule)
+        self.assertEqual(moves1.location_id, self.loc_stock)
+        self.assertEqual(moves2.rule_id, route.rule_ids)
+        self.assertEqual(moves2.location_id, self.loc_bin1)
+
     def test_defer_creation(self):
         self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
 
@@ -221,6 +661,76 @@ class TestAvailableToPromiseRelease(PromiseReleaseCommonCase):
             ],
         )
 
+    def test_defer_creation_move_type_one_multi_move(self):
+        """A short move keeps all the moves of the picking"""
+        self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        self._update_qty_in_location(self.loc_bin1, self.product1, 20.0)
+        self._update_qty_in_location(self.loc_bin1, self.product2, 2.0)
+        cust_picking = self._create_picking_chain(
+            self.wh, [(self.product1, 10.0), (self.product2, 5.0)], move_type="one"
+        )
+        move1 = cust_picking.move_lines.filtered(
+            lambda move: move.product_id == self.product1
+        )
+        move2 = cust_picking.move_lines - move1
+        # the move of product1 is available but not its sibling
+        plan = move1._get_release_plan()
+        self.assertEqual(plan[move1].outcome, "all_at_once")
+        self.assertEqual(plan[move2].outcome, "all_at_once")
+        move1.release_available_to_promise()
+        cust_picking.release_available_to_promise()
+        out_picking = self._pickings_in_group(cust_picking.group_id) - cust_picking
+        self.assertFalse(out_picking)
+        self.assertTrue(all(cust_picking.move_lines.mapped("need_release")))
+
+        self._update_qty_in_location(self.loc_bin1, self.product2, 5.0)
+        # releasing one move releases the whole picking
+        self.assertEqual(move1._get_release_plan().keys(), {move1, move2})
+        move1.release_available_to_promise()
+        out_picking = self._pickings_in_group(cust_picking.group_id) - cust_picking
+        self.assertEqual(len(out_picking.move_lines), 2)
+        self.assertFalse(cust_picking.backorder_ids)
+        self.assertFalse(any(cust_picking.move_lines.mapped("need_release")))
+
+    def test_picking_release_ratio(self):
+        self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        self._update_qty_in_location(self.loc_bin1, self.product1, 7.0)
+        picking1 = self._create_picking_chain(
+            self.wh, [(self.product1, 20)], date="2019-10-01"
+        )
+        picking2 = self._create_picking_chain(
+            self.wh, [(self.product1, 5)], date="2019-10-02"
+        )
+        pickings = picking1 | picking2
+        self.assertRecordValues(
+            pickings,
+            [
+                {"need_release": True, "release_ratio": 35.0},
+                {"need_release": True, "release_ratio": 0.0},
+            ],
+        )
+        Picking = self.env["stock.picking"]
+        self.assertEqual(
+            Picking.search([("id", "in", pickings.ids), ("need_release", "=", True)]),
+            pickings,
+        )
+        self.assertEqual(
+            Picking.search([("id", "in", pickings.ids), ("release_ratio", ">", 0)]),
+            picking1,
+        )
+        self._check_release_ratio_search(pickings)
+        picking1.release_available_to_promise()
+        # the quantity released is no longer to release, the backorder is
+        self.assertFalse(picking1.need_release)
+        self.assertTrue(picking1.backorder_ids.need_release)
+        self.assertEqual(
+            Picking.search([("id", "in", pickings.ids), ("need_release", "=", True)]),
+            picking2,
+        )
+        # the ratio of a picking which does not need a release is 0
+        self.assertEqual(picking1.release_ratio, 0.0)
+        self._check_release_ratio_search(pickings | picking1.backorder_ids)
+
     def test_defer_creation_backorder(self):
         self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
 
@@ -387,6 +897,45 @@ class TestAvailableToPromiseRelease(PromiseReleaseCommonCase):
             [{"product_qty": 10.0, "product_id": self.product2.id}],
         )
 
+    def test_defer_multi_move_backorder(self):
+        self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
+        self._update_qty_in_location(self.loc_bin1, self.product1, 3.0)
+        self._update_qty_in_location(self.loc_bin1, self.product2, 4.0)
+        cust_picking = self._create_picking_chain(
+            self.wh, [(self.product1, 10), (self.product2, 10)]
+        )
+        message_count = len(cust_picking.message_ids)
+        cust_picking.release_available_to_promise()
+
+        backorder = cust_picking.backorder_ids
+        self.assertEqual(len(backorder), 1)
+        self.assertRecordValues(
+            cust_picking.move_lines.sorted("product_id"),
+            [
+                {"product_id": self.product1.id, "product_qty": 3.0},
+                {"product_id": self.product2.id, "product_qty": 4.0},
+            ],
+        )
+        self.assertRecordValues(
+            backorder.move_lines.sorted("product_id"),
+            [
+                {
+                    "product_id": self.product1.id,
+                    "product_qty": 7.0,
+                    "need_release": True,
+                    "state": "waiting",
+                },
+                {
+                    "product_id": self.product2.id,
+                    "product_qty": 6.0,
+                    "need_release": True,
+                    "state": "waiting",
+                },
+            ],
+        )
+        # one message for the backorder
+        self.assertEqual(len(cust_picking.message_ids), message_count + 1)
+
     def test_defer_creation_uom(self):
         self.wh.delivery_route_id.write({"available_to_promise_defer_pull": True})
 
@@ -1 +1,2 @@
 from . import stock_move_release
+from . import stock_release_plan
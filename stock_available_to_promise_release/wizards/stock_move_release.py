@@ -8,11 +8,21 @@ class StockMoveRelease(models.TransientModel):
     _name = "stock.move.release"
     _description = "Stock Move Release"
 
-    def release(self):
-        moves = (
+    def _get_moves(self):
+        return (
             self.env["stock.move"]
             .browse(self.env.context.get("active_ids", []))
             .exists()
         )
+
+    def release(self):
+        moves = self._get_moves()
         moves.release_available_to_promise()
         return {"type": "ir.actions.act_window_close"}
+
+    def release_in_background(self):
+        moves = self._get_moves()
+        runs = moves.release_available_to_promise_in_background()
+        if not runs:
+            return {"type": "ir.actions.act_window_close"}
+        return dict(runs.action_view_runs(), target="current")
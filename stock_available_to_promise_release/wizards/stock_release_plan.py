@@ -0,0 +1,115 @@
+# Copyright 2020 Camptocamp (https://www.camptocamp.com)
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, fields, models
+
+OUTCOMES = [
+    ("full", "Released"),
+    ("partial", "Partially released"),
+    ("nothing", "Not available"),
+    ("all_at_once", "Not released, ship all at once"),
+]
+
+
+class StockReleasePlan(models.TransientModel):
+    _name = "stock.release.plan"
+    _description = "Stock Release Plan"
+
+    line_ids = fields.One2many(
+        "stock.release.plan.line", "plan_id", string="Moves", readonly=True
+    )
+    full_count = fields.Integer(compute="_compute_counts", string="Released")
+    partial_count = fields.Integer(
+        compute="_compute_counts", string="Partially Released"
+    )
+    not_released_count = fields.Integer(
+        compute="_compute_counts", string="Not Released"
+    )
+    backorder_count = fields.Integer(
+        compute="_compute_counts", string="Backorders Created"
+    )
+
+    @api.depends("line_ids.outcome")
+    def _compute_counts(self):
+        for plan in self:
+            outcomes = plan.line_ids.mapped("outcome")
+            plan.full_count = outcomes.count("full")
+            plan.partial_count = outcomes.count("partial")
+            plan.not_released_count = len(outcomes) - (
+                plan.full_count + plan.partial_count
+            )
+            plan.backorder_count = len(
+                plan.line_ids.filtered("backorder").mapped("picking_id")
+            )
+
+    def _get_moves(self):
+        active_ids = self.env.context.get("active_ids", [])
+        if self.env.context.get("active_model") == "stock.picking":
+            return self.env["stock.picking"].browse(active_ids).exists().move_lines
+        return self.env["stock.move"].browse(active_ids).exists()
+
+    @api.model
+    def default_get(self, fields_list):
+        res = super().default_get(fields_list)
+        if "line_ids" not in fields_list:
+            return res
+        move_plans = self._get_moves()._get_release_plan()
+        backorder_pickings = {
+            move.picking_id
+            for move, plan in move_plans.items()
+            if plan.outcome == "partial"
+        }
+        res["line_ids"] = [
+            (
+                0,
+                0,
+                {
+                    "move_id": move.id,
+                    "available_qty": plan.available_qty,
+                    "release_qty": plan.release_qty,
+                    "remaining_qty": plan.remaining_qty,
+                    "outcome": plan.outcome,
+                    "backorder": move.picking_id in backorder_pickings,
+                },
+            )
+            for move, plan in move_plans.items()
+        ]
+        return res
+
+    def release(self):
+        moves = self.line_ids.move_id
+        if self.env.context.get("active_model") == "stock.picking":
+            # the release of the pickings cleans up the context of the sale
+            # orders (see ``stock.picking.release_available_to_promise``)
+            moves.picking_id.release_available_to_promise()
+        else:
+            moves.release_available_to_promise()
+        return {"type": "ir.actions.act_window_close"}
+
+
+class StockReleasePlanLine(models.TransientModel):
+    _name = "stock.release.plan.line"
+    _description = "Stock Release Plan Line"
+    _order = "picking_id, id"
+
+    plan_id = fields.Many2one("stock.release.plan", required=True, ondelete="cascade")
+    move_id = fields.Many2one("stock.move", required=True, ondelete="cascade")
+    picking_id = fields.Many2one(related="move_id.picking_id", store=True)
+    product_id = fields.Many2one(related="move_id.product_id")
+    product_qty = fields.Float(related="move_id.product_qty")
+    date_priority = fields.Datetime(related="move_id.date_priority")
+    available_qty = fields.Float(
+        string="Available to Promise", digits="Product Unit of Measure"
+    )
+    release_qty = fields.Float(
+        string="Quantity Released", digits="Product Unit of Measure"
+    )
+    remaining_qty = fields.Float(
+        string="Quantity Not Released", digits="Product Unit of Measure"
+    )
+    outcome = fields.Selection(OUTCOMES, required=True)
+    backorder = fields.Boolean(
+        string="Picking Backorder",
+        help="A backorder is created for the quantities of the transfer "
+        "which are not released.",
+    )